@@ -1,66 +1,183 @@
-# app.py — Pico-Chan VPS (channels + canvas 24x8 + dédoublonnage + couleur par hash)
+# app.py — Pico-Chan VPS (salons + channels + canvas 24x8 par défaut + dédoublonnage + couleur par hash)
 # FastAPI + SSE. Messages:
 #   discussion: {id, ts, chan:"discussion", text, hash, color}
 #   dessin    : {id, ts, chan:"dessin",     art,  hash, color}
 #
 # Endpoints principaux:
-#   GET  /                  -> UI (Jinja)
+# Chaque endpoint prend ?room=<nom> (def: "main"; [a-z0-9_-]{1,32}, cf. rooms.py): salon créé au
+# premier usage, évincé de la mémoire quand plus personne ne l'écoute.
+#
+#   GET  /                  -> UI (Jinja; /?room=nom)
 #   GET  /channels          -> ["discussion","dessin"]
 #   GET  /poll?last_id&chan -> liste des messages du channel
-#   GET  /stream?chan       -> SSE live (sans historique) pour le channel
+#   GET  /stream?chan       -> SSE live pour le channel (reprise via Last-Event-ID / ?last_id)
 #   POST /msg               -> post texte (chan=discussion)
-#   GET  /dessin/canvas     -> état actuel du canvas 24x8
-#   GET  /dessin/stream     -> SSE du canvas (full initial + diffs)
+#   GET  /dessin/canvas     -> état actuel du canvas (w x h)
+#   GET  /dessin/stream     -> SSE du canvas (full initial + diffs groupés par tick, reprise par version)
 #   POST /dessin/diff       -> appliquer un ou plusieurs pixels
 #   POST /dessin/publish    -> publier un snapshot du canvas dans le fil "dessin"
-#   GET  /healthz           -> état serveur
+#   WS   /ws                -> tout ce qui précède sur une connexion (abonnements, pixels, posts)
+#   GET  /healthz           -> état serveur (/healthz/subs: connexions les plus en retard, si PICOCHAN_HEALTHZ_SUBS=1)
+#   GET  /metrics           -> métriques Prometheus (cf. metrics.py)
 #
 # Réglages via env:
 #   PICOCHAN_SECRET_SALT            (def: "pc/sel-🌊-2025")
 #   PICOCHAN_HASH_ROTATE_DAILY=1/0  (def: 1)
-#   PICOCHAN_POST_COOLDOWN=float s  (def: 1.0)
-#   PICOCHAN_MAX_MSGS=int           (def: 512)
+#   PICOCHAN_POST_COOLDOWN=float s  (def: 1.0; défaut des limites /msg et /dessin/publish)
+#   PICOCHAN_RATE_MSG / _PUBLISH / _DIFF / _SUB="rate,burst"  (jetons/s, capacité; "0" = illimité)
+#                                   (def: 1/cooldown,1 / 1/cooldown,1 / 60,120 / 2,20)
+#   PICOCHAN_SUBS_PER_IP=int        (def: 32 abonnements SSE + /ws simultanés par IP; 0 = illimité)
+#   PICOCHAN_WS_MAX_SUBS=int        (def: 8 abonnements par connexion /ws)
+#   PICOCHAN_RATE_MAX_KEYS=int      (def: 100000 IP suivies max par route)
+#   PICOCHAN_MAX_MSGS=int           (def: 512, par channel)
+#   PICOCHAN_MAX_MSGS_<CHAN>=int    (def: PICOCHAN_MAX_MSGS; ex: PICOCHAN_MAX_MSGS_DESSIN=128)
+#   PICOCHAN_SSE_QUEUE=int          (def: 256 frames en attente max par client SSE)
+#   PICOCHAN_SSE_OVERFLOW=drop|disconnect           (def: disconnect; le client rattrape via Last-Event-ID)
+#   PICOCHAN_CANVAS_OVERFLOW=snapshot|drop|disconnect (def: snapshot)
+#   PICOCHAN_CANVAS_W / _H=int      (def: 24 / 8)
+#   PICOCHAN_CANVAS_HZ=float        (def: 25; fréquence max des diffs canvas diffusés)
+#   PICOCHAN_WS=1/0                 (def: 1; endpoint /ws, sinon SSE + POST seulement)
+#   PICOCHAN_HEALTHZ_SUBS=1/0       (def: 0; endpoint de diagnostic /healthz/subs)
+#   PICOCHAN_HASH_CACHE=int         (def: 4096 couples (ip, jour) -> hash/couleur gardés en LRU)
+#   PICOCHAN_MAX_ROOMS=int          (def: 1000 salons résidents, les moins récents évincés au-delà)
+#   PICOCHAN_ROOM_IDLE_S=float      (def: 300; salon sans abonné évincé après ce délai)
+#   PICOCHAN_ROOM_MSGS=int          (def: 128 messages par channel hors salon "main")
+#   PICOCHAN_ROOM_JOURNAL=int       (def: 64 ticks canvas gardés pour la reprise hors salon "main")
+#   PICOCHAN_ROOM_CANVAS=1/0        (def: 1; canvas dans les salons autres que "main")
+#   PICOCHAN_ROOM_TTL_S=float       (def: 604800; dossier disque d'un salon supprimé après ce délai sans écriture)
+#   PICOCHAN_MAX_ROOM_DIRS=int      (def: 10000 dossiers de salons sur disque, les plus anciens supprimés; 0 = illimité)
+#   PICOCHAN_DATA_DIR=path          (def: vide = pas de persistance; cf. store.py)
+#   PICOCHAN_BACKEND=local|hub      (def: local; "hub" = N workers gunicorn, cf. broker.py)
+#   PICOCHAN_HUB_SOCK=path          (def: /tmp/picochan-hub.sock)
 
-import os, time, asyncio, hashlib, json as _json
-from collections import deque
-from typing import Deque, Dict, Any, List
+import os, gzip, time, heapq, asyncio, hashlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Deque, Dict, Any, List, Optional, Set, Tuple
 
-from fastapi import FastAPI, Request, HTTPException, Form, Response
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi import FastAPI, Request, HTTPException, Form, Response, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, Field
+from starlette.requests import HTTPConnection
+from starlette.websockets import WebSocketDisconnect
+
+try:
+    import brotli
+except ImportError:   # optionnel: variante br de la page d'accueil
+    brotli = None
+
+import codec, metrics
+from limits import ActiveCounter, RateLimiter, parse_rate
+from broker import BrokerUnavailable, make_broker, clean_cells, HUB_SOCK
+from rooms import (ROOM_DEFAULT, MAX_ROOMS, ROOM_IDLE_S, valid_room, max_msgs_for, canvas_size,
+                   ROOM_CANVAS, retention, has_canvas, canvas_journal)
 
 # --------------------------
 # Réglages
 # --------------------------
 TITLE = "Pico-chan"
-MAX_MSGS = int(os.getenv("PICOCHAN_MAX_MSGS", "512"))
+MAX_MSGS = max_msgs_for(None)
 MAX_TEXT = 240
 POLL_BATCH = 64
 POST_COOLDOWN = float(os.getenv("PICOCHAN_POST_COOLDOWN", "1.0"))
 CLIENT_ACTIVE_S = 10
+RATE_MAX_KEYS = int(os.getenv("PICOCHAN_RATE_MAX_KEYS", "100000"))
+_post_rate = (1.0 / POST_COOLDOWN) if POST_COOLDOWN > 0 else 0.0
+RATES = {
+    "msg":     parse_rate(os.getenv("PICOCHAN_RATE_MSG"), _post_rate, 1),
+    "publish": parse_rate(os.getenv("PICOCHAN_RATE_PUBLISH"), _post_rate, 1),
+    "diff":    parse_rate(os.getenv("PICOCHAN_RATE_DIFF"), 60, 120),
+    "sub":     parse_rate(os.getenv("PICOCHAN_RATE_SUB"), 2, 20),
+}
+# un abonnement garde son salon en mémoire (jamais évincé tant qu'il est écouté) -> bornés
+SUBS_PER_IP = int(os.getenv("PICOCHAN_SUBS_PER_IP", "32"))   # SSE + /ws, 0 = illimité
+WS_MAX_SUBS = int(os.getenv("PICOCHAN_WS_MAX_SUBS", "8"))    # par connexion /ws
 
 SECRET_SALT = os.getenv("PICOCHAN_SECRET_SALT", "pc/sel-🌊-2025")
 HASH_ROTATE_DAILY = os.getenv("PICOCHAN_HASH_ROTATE_DAILY", "1") not in ("0","false","False","FALSE")
+BACKEND = os.getenv("PICOCHAN_BACKEND", "local")
+SSE_QUEUE_MAX = int(os.getenv("PICOCHAN_SSE_QUEUE", "256"))
+SUBS_LIST_MAX = 500   # /healthz/subs: connexions listées au plus
+SSE_OVERFLOW = os.getenv("PICOCHAN_SSE_OVERFLOW", "disconnect")
+CANVAS_OVERFLOW = os.getenv("PICOCHAN_CANVAS_OVERFLOW", "snapshot")
+WS_ENABLED = os.getenv("PICOCHAN_WS", "1") not in ("0","false","False","FALSE")
+HEALTHZ_SUBS = os.getenv("PICOCHAN_HEALTHZ_SUBS", "0") not in ("0","false","False","FALSE")
+HASH_CACHE_MAX = int(os.getenv("PICOCHAN_HASH_CACHE", "4096"))
 
-# Channels
+# Channels (les mêmes dans chaque salon)
 CHANNELS = ("discussion", "dessin")
 
-# Canvas 24x8
-CANVAS_W, CANVAS_H = 24, 8
-_canvas_lock = asyncio.Lock()
-_canvas: List[List[str]] = [[ " " for _ in range(CANVAS_W) ] for __ in range(CANVAS_H)]
-_canvas_subs: List[asyncio.Queue] = []  # SSE abonnés du canvas
+# Canvas (24x8 par défaut)
+CANVAS_W, CANVAS_H = canvas_size()
+CANVAS_HZ = float(os.getenv("PICOCHAN_CANVAS_HZ", "25"))
 
 # --------------------------
-# État messages
+# État messages (miroir local; les ids viennent du backend)
 # --------------------------
-_messages: Deque[Dict[str, Any]] = deque(maxlen=MAX_MSGS)
-_next_id = 1
-_last_post: Dict[str, float] = {}   # ip -> last ts (rate limit)
-_clients: Dict[str, float] = {}     # ip -> last ts (clients actifs)
-_subscribers: List[asyncio.Queue] = []  # SSE abonnés des messages
+POLL_CACHE_MAX = 256   # fenêtres /poll gardées en cache par channel (salon "main")
+ROOM_POLL_CACHE = 16   # idem, autres salons
+
+class ChannelLog:
+    # Ring buffer d'un channel: ids croissants -> recherche par bisect depuis last_id.
+    # La tête est coupée paresseusement (del en bloc) pour garder l'append en O(1) amorti.
+    def __init__(self, maxlen: int, cache_max: int = POLL_CACHE_MAX):
+        self.maxlen = maxlen
+        self.cache_max = cache_max
+        self.ids: List[int] = []
+        self.msgs: List[Dict[str, Any]] = []
+        self.frames: List[bytes] = []     # frame SSE de chaque message (pour la reprise)
+        self.head = 0
+        self._poll_cache: Dict[int, Tuple[bytes, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.head
+
+    def append(self, msg: Dict[str, Any]):
+        self.ids.append(msg["id"])
+        self.msgs.append(msg)
+        self.frames.append(sse_frame(msg, msg["id"]))
+        if len(self) > self.maxlen:
+            self.head += 1
+            if self.head >= self.maxlen:
+                del self.ids[:self.head]
+                del self.msgs[:self.head]
+                del self.frames[:self.head]
+                self.head = 0
+        self._poll_cache.clear()
+
+    def clear(self):
+        self.ids.clear(); self.msgs.clear(); self.frames.clear(); self.head = 0
+        self._poll_cache.clear()
+
+    def index_after(self, last_id: int) -> int:
+        return bisect_right(self.ids, last_id, self.head)
+
+    def frames_since(self, last_id: int) -> bytes:
+        return b"".join(self.frames[self.index_after(last_id):])
+
+    def last_frame(self) -> bytes:
+        return self.frames[-1]
+
+    def poll_payload(self, last_id: int, limit: int) -> Tuple[bytes, str]:
+        # (corps JSON, ETag) mis en cache par fenêtre jusqu'au prochain append;
+        # l'ETag dépend du contenu -> identique d'un worker à l'autre
+        i = self.index_after(last_id)
+        hit = self._poll_cache.get(i)
+        if hit is None:
+            body = codec.dumps(self.msgs[i:i + limit])
+            hit = (body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"')
+            if len(self._poll_cache) >= self.cache_max: self._poll_cache.clear()
+            self._poll_cache[i] = hit
+        return hit
+
+_broker = make_broker(BACKEND, HUB_SOCK)
+_limits: Dict[str, RateLimiter] = {route: RateLimiter(r, b, RATE_MAX_KEYS) for route, (r, b) in RATES.items()}
+_presence = ActiveCounter(CLIENT_ACTIVE_S)   # IP distinctes vues (approx.) sur la fenêtre
 
 # --------------------------
 # Utils
@@ -68,18 +185,22 @@ _subscribers: List[asyncio.Queue] = []  # SSE abonnés des messages
 def now_s() -> int:
     return int(time.time())
 
-def client_ip(request: Request) -> str:
+def client_ip(request: HTTPConnection) -> str:
     # récupère l'IP réelle si derrière Nginx
     xff = request.headers.get("x-forwarded-for")
     if xff:
         return xff.split(",")[0].strip()
     return request.client.host if request.client else "0.0.0.0"
 
-def anon_hash_for_ip(ip: str, t: int) -> str:
-    day_bucket = (t // 86400) if HASH_ROTATE_DAILY else 0
+def client_identity(ip: str, t: int) -> Tuple[str, str]:
+    # (hash, couleur) d'un auteur; stable sur la journée -> SHA-1 + HSL une fois par (ip, jour)
+    return _identity(ip, (t // 86400) if HASH_ROTATE_DAILY else 0)
+
+@lru_cache(maxsize=HASH_CACHE_MAX)
+def _identity(ip: str, day_bucket: int) -> Tuple[str, str]:
     payload = f"{ip}|{SECRET_SALT}|{day_bucket}".encode()
     hx = hashlib.sha1(payload).hexdigest()[:6].upper()  # 6 hex
-    return hx
+    return hx, color_from_hash(hx)
 
 # Couleur stable depuis le hash (HSL pastel -> HEX)
 def hsl_to_rgb(h, s, l):
@@ -110,154 +231,673 @@ def color_from_hash(hx6: str) -> str:
     r,g,b = hsl_to_rgb(hue, sat, lig)
     return f"#{r:02X}{g:02X}{b:02X}"
 
+def touch_client(request: HTTPConnection) -> str:
+    ip = client_ip(request)
+    _presence.add(ip)
+    return ip
+
 def active_clients_count() -> int:
-    t = now_s()
-    dead = [ip for ip, ts in list(_clients.items()) if (t - ts) > CLIENT_ACTIVE_S]
-    for ip in dead:
-        _clients.pop(ip, None)
-    return len(_clients)
+    return _presence.count()
+
+def rate_limit(route: str, ip: str):
+    if not _limits[route].allow(ip):
+        M_RATE_LIMITED.inc(route)
+        raise HTTPException(status_code=429, detail="slow down")
 
-def jdump(o) -> str:
-    return _json.dumps(o, separators=(",",":"))
+def subscribe_limit(ip: str):
+    # avant le join du salon (chargement, reprise disque)
+    if SUBS_PER_IP > 0 and _hub.ip_count.get(ip, 0) >= SUBS_PER_IP:
+        M_RATE_LIMITED.inc("subs_per_ip")
+        raise HTTPException(status_code=429, detail="too many subscriptions")
+    rate_limit("sub", ip)
+
+class FastJSONResponse(JSONResponse):
+    # corps déjà encodé (bytes, gardé en cache) ou objet encodé par codec (orjson si présent);
+    # renvoyé tel quel par les routes -> pas de passage par jsonable_encoder de FastAPI
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else codec.dumps(content)
 
 # Canvas helpers
-def canvas_as_lines() -> List[str]:
-    return ["".join(row) for row in _canvas]
+class Canvas:
+    # Buffer compact (un code point par cellule), version attribuée par le backend,
+    # cellules modifiées depuis le dernier tick, snapshot encodé une fois par version.
+    def __init__(self, w: int, h: int, journal: int = 1024):
+        self.w, self.h = w, h
+        self.cells = array("I", [32]) * (w * h)
+        self.v = 0
+        self.dirty: Set[int] = set()
+        self.flushed_v = 0
+        self.journal: Deque[Tuple[int, int, bytes]] = deque(maxlen=journal)  # (v_from, v_to, frame)
+        self._lines: Tuple[int, List[str]] = (-1, [])
+        self._full: Tuple[int, bytes] = (-1, b"")
+        self._json: Tuple[int, bytes] = (-1, b"")
+
+    def set_cells(self, cells: List[List[Any]], v: int):
+        w, buf, dirty = self.w, self.cells, self.dirty
+        for x, y, ch in cells:
+            if not (0 <= x < w and 0 <= y < self.h): continue
+            i, c = y * w + x, ord(ch)
+            if buf[i] != c:
+                buf[i] = c
+                dirty.add(i)
+        self.v = v
+
+    def load(self, lines: Optional[List[str]], v: int):
+        # état complet (join du salon): le journal ne correspond plus
+        self.cells = array("I", [32]) * (self.w * self.h)
+        for y, line in enumerate((lines or [])[:self.h]):
+            for x, ch in enumerate(line[:self.w]):
+                self.cells[y * self.w + x] = ord(ch)
+        self.v = self.flushed_v = v
+        self.dirty.clear()
+        self.journal.clear()
+        self._lines, self._full, self._json = (-1, []), (-1, b""), (-1, b"")
+
+    def lines(self) -> List[str]:
+        v, lines = self._lines
+        if v != self.v:
+            w, buf = self.w, self.cells
+            lines = ["".join(map(chr, buf[y * w:(y + 1) * w])) for y in range(self.h)]
+            self._lines = (self.v, lines)
+        return lines
+
+    def text(self) -> str:
+        return "\n".join(self.lines())
+
+    def json_body(self) -> bytes:
+        # corps de GET /dessin/canvas, encodé une fois par version
+        v, body = self._json
+        if v != self.v:
+            body = codec.dumps({"w": self.w, "h": self.h, "v": self.v, "lines": self.lines()})
+            self._json = (self.v, body)
+        return body
+
+    def full_frame(self) -> bytes:
+        v, frame = self._full
+        if v != self.v:
+            frame = sse_frame({"full": {"w": self.w, "h": self.h, "lines": self.lines()}}, self.v)
+            self._full = (self.v, frame)
+        return frame
+
+    def frames_since(self, v0: int) -> bytes:
+        # ticks du journal si le client n'est pas trop loin, sinon snapshot complet;
+        # ce qui n'est pas encore flushé partira au prochain tick
+        if self.flushed_v <= v0 <= self.v: return b""
+        j = self.journal
+        if 0 <= v0 < self.flushed_v and j and j[0][0] <= v0:
+            return b"".join(f for _, vt, f in j if vt > v0)
+        return self.full_frame()
+
+    def flush(self) -> Optional[bytes]:
+        # un tick: toutes les cellules changées en une frame {"px":[i,...],"ch":"..."} (i = y*w+x)
+        if not self.dirty: return None
+        if len(self.dirty) * 2 > len(self.cells):
+            frame = self.full_frame()   # plus petit qu'un diff de la moitié du canvas
+        else:
+            idx = sorted(self.dirty)
+            frame = sse_frame({"px": idx, "ch": "".join(chr(self.cells[i]) for i in idx)}, self.v)
+        self.journal.append((self.flushed_v, self.v, frame))
+        self.flushed_v = self.v
+        self.dirty.clear()
+        return frame
+
+_canvas_dirty: Optional[asyncio.Event] = None   # créé par lifespan (boucle de service, py < 3.10)
+_dirty_rooms: Set["Room"] = set()   # salons dont le canvas a changé depuis le dernier tick
+
+async def canvas_ticker(dirty: asyncio.Event):
+    # au plus CANVAS_HZ frames/s par canvas; ne se réveille pas tant que rien ne change;
+    # un tick ne touche que les salons modifiés
+    period = 1.0 / CANVAS_HZ
+    while True:
+        await dirty.wait()
+        await asyncio.sleep(period)
+        dirty.clear()
+        rooms = list(_dirty_rooms)
+        _dirty_rooms.clear()
+        for room in rooms:
+            frame = room.canvas.flush()
+            if frame: _hub.publish(room.keys["canvas"], frame)
+
+async def canvas_set_cells(room: "Room", cells: List[List[Any]]) -> int:
+    # validé ici, appliqué (et diffusé) au retour de l'évènement du backend
+    cells = clean_cells(cells, CANVAS_W, CANVAS_H)
+    if cells:
+        t0 = time.perf_counter()
+        await _broker.publish_cells(room.name, cells)
+        M_PUBLISH.observe(time.perf_counter() - t0, "canvas")
+    return len(cells)
+
+# --------------------------
+# Fan-out SSE: un encodage par message, les mêmes bytes pour chaque abonné
+# --------------------------
+PING_FRAME = b"event: ping\ndata: {}\n\n"
+RETRY_FRAME = b"retry: 1200\n\n"   # délai de reconnexion natif d'EventSource
+SSE_PING_S = 15.0
+# clés de fan-out: "<salon>/<channel>" et "<salon>/canvas" (/dessin/stream)
+
+def key_kind(key: str) -> str:
+    # partie channel d'une clé: label des métriques (borné, contrairement aux noms de salon)
+    return key.rpartition("/")[2]
+
+def sse_frame(o, eid: Optional[int] = None) -> bytes:
+    head = b"id: %d\n" % eid if eid is not None else b""
+    return head + b"data: " + codec.dumps(o) + b"\n\n"
+
+def last_event_id(request: Request, default: int) -> int:
+    # en-tête renvoyé par EventSource à la reconnexion, sinon paramètre de query
+    raw = request.headers.get("last-event-id")
+    if raw:
+        try: return int(raw)
+        except ValueError: pass
+    return default
+
+class Subscriber:
+    # File bornée d'un client SSE. En cas de débordement (client lent):
+    #   drop       -> on jette les frames les plus anciennes
+    #   snapshot   -> on vide la file et on renverra un état complet (resync())
+    #   disconnect -> on coupe; le client revient avec Last-Event-ID et rattrape
+    __slots__ = ("key", "kind", "ip", "maxlen", "policy", "resync", "buf", "closed", "resync_pending",
+                 "since", "behind_since", "sent", "dropped", "hwm", "_wake")
+
+    def __init__(self, key: str, ip: str, maxlen: int, policy: str, resync=None):
+        self.key, self.kind, self.ip = key, key_kind(key), ip
+        self.maxlen, self.policy, self.resync = maxlen, policy, resync
+        self.buf: Deque[bytes] = deque()
+        self.closed = False
+        self.resync_pending = False
+        self.since = time.monotonic()
+        self.behind_since = 0.0
+        self.sent = self.dropped = self.hwm = 0
+        self._wake = asyncio.Event()
+
+    def push(self, frame: bytes):
+        if self.closed: return
+        if len(self.buf) >= self.maxlen:
+            if self.policy == "snapshot" and self.resync is not None:
+                self.dropped += len(self.buf)
+                self.buf.clear()
+                self.resync_pending = True
+            elif self.policy == "disconnect":
+                self.dropped += len(self.buf)
+                self.buf.clear()
+                self.closed = True
+                self._wake.set()
+                return
+            else:
+                self.buf.popleft()
+                self.dropped += 1
+        if not self.buf: self.behind_since = time.monotonic()
+        self.buf.append(frame)
+        if len(self.buf) > self.hwm: self.hwm = len(self.buf)
+        self._wake.set()
+
+    async def get(self, timeout: float) -> Optional[bytes]:
+        # tout ce qui est en attente, en un seul chunk; PING_FRAME si rien; None si coupé
+        if not self.buf and not self.resync_pending and not self.closed:
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                return PING_FRAME
+        if self.closed: return None
+        out = b""
+        if self.resync_pending:
+            self.resync_pending = False
+            out = self.resync()
+        n = len(self.buf)
+        out += b"".join(self.buf)
+        self.buf.clear()
+        self.sent += n
+        return out or PING_FRAME
+
+    def lag_s(self) -> float:
+        return round(time.monotonic() - self.behind_since, 3) if self.buf else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        # rien qui identifie le client (ni IP, ni hash d'auteur)
+        return {"key": self.key, "policy": self.policy,
+                "age_s": int(time.monotonic() - self.since),
+                "queued": len(self.buf), "lag_s": self.lag_s(), "hwm": self.hwm,
+                "sent": self.sent, "dropped": self.dropped}
+
+class FanoutHub:
+    def __init__(self):
+        self._subs: Dict[str, Set[Subscriber]] = {}
+        self.kind_count: Dict[str, int] = {}
+        self.ip_count: Dict[str, int] = {}
+        # cumuls par channel des abonnés déjà partis (les vivants sont lus au scrape de /metrics)
+        self.closed_dropped: Dict[str, int] = {}
+        self.closed_hwm: Dict[str, int] = {}
+
+    def subscribe(self, key: str, ip: str, policy: str, resync=None) -> Subscriber:
+        sub = Subscriber(key, ip, SSE_QUEUE_MAX, policy, resync)
+        self._subs.setdefault(key, set()).add(sub)
+        self.kind_count[sub.kind] = self.kind_count.get(sub.kind, 0) + 1
+        self.ip_count[ip] = self.ip_count.get(ip, 0) + 1
+        M_SSE_OPENED.inc(sub.kind)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        subs = self._subs.get(sub.key)
+        if subs is None or sub not in subs: return
+        subs.discard(sub)
+        if not subs: del self._subs[sub.key]
+        k = sub.kind
+        self.kind_count[k] -= 1
+        n = self.ip_count[sub.ip] - 1
+        if n: self.ip_count[sub.ip] = n
+        else: del self.ip_count[sub.ip]
+        self.closed_dropped[k] = self.closed_dropped.get(k, 0) + sub.dropped
+        self.closed_hwm[k] = max(self.closed_hwm.get(k, 0), sub.hwm)
+
+    def count(self, key: str) -> int:
+        return len(self._subs.get(key, ()))
+
+    def all(self):
+        for subs in self._subs.values():
+            yield from subs
+
+    def kinds(self):
+        return sorted(set(self.kind_count) | set(self.closed_hwm))
+
+    def publish(self, key: str, frame: bytes):
+        # pas d'await ici -> le set ne bouge pas pendant l'itération
+        subs = self._subs.get(key)
+        if not subs: return
+        t0 = time.perf_counter()
+        for sub in subs:
+            sub.push(frame)
+        M_FANOUT.observe(time.perf_counter() - t0, key_kind(key))
+
+_hub = FanoutHub()
+
+async def sse_pump(key: str, ip: str, policy: str, first=None, resync=None):
+    # first(): frames initiales (rattrapage), calculées juste après l'abonnement
+    # sans await entre les deux -> ni trou ni doublon avec le live.
+    # Pas de request.is_disconnected(): StreamingResponse écoute déjà http.disconnect
+    # sur receive() et annule ce générateur (le finally désabonne).
+    sub = _hub.subscribe(key, ip, policy, resync)
+    try:
+        yield RETRY_FRAME + (first() if first is not None else b"")
+        while True:
+            chunk = await sub.get(SSE_PING_S)
+            if chunk is None: break
+            yield chunk
+    finally:
+        _hub.unsubscribe(sub)
+
+# --------------------------
+# Salons: miroirs locaux des salons servis par ce process
+# --------------------------
+class Room:
+    # historiques par channel + canvas optionnel; clés de fan-out préfixées du nom du salon
+    __slots__ = ("name", "logs", "canvas", "lock", "keys", "last")
+
+    def __init__(self, name: str):
+        self.name = name
+        cache = POLL_CACHE_MAX if name == ROOM_DEFAULT else ROOM_POLL_CACHE
+        self.logs = {c: ChannelLog(retention(name, c), cache) for c in CHANNELS}
+        self.canvas = Canvas(CANVAS_W, CANVAS_H, canvas_journal(name)) if has_canvas(name) else None
+        self.lock = asyncio.Lock()   # diffs et snapshot publié du canvas
+        self.keys = {c: name + "/" + c for c in CHANNELS + ("canvas",)}
+        self.last = time.monotonic()
+
+    def subscribers(self) -> int:
+        return sum(_hub.count(k) for k in self.keys.values())
+
+    def load(self, ev: Dict[str, Any]):
+        # état complet du backend (join, ou re-join après reconnexion au hub):
+        # les abonnés déjà là reçoivent ce qu'ils ont manqué
+        prev = {c: (log.ids[-1] if len(log) else 0) for c, log in self.logs.items()}
+        for log in self.logs.values(): log.clear()
+        for msg in ev.get("msgs") or []:
+            log = self.logs.get(msg.get("chan"))
+            if log is not None: log.append(msg)
+        for c, log in self.logs.items():
+            missed = log.frames_since(prev[c]) if prev[c] else b""
+            if missed: _hub.publish(self.keys[c], missed)
+        if self.canvas is not None:
+            self.canvas.load(ev.get("lines"), ev.get("v", 0))
+            _hub.publish(self.keys["canvas"], self.canvas.full_frame())
+
+class Rooms:
+    # Salons résidents rangés par dernier accès (OrderedDict): get() en O(1), éviction par la tête.
+    # Premier accès -> join auprès du backend (un seul en vol par salon); éviction -> leave,
+    # quand plus personne n'écoute depuis idle_s ou au-delà de max_rooms. "main" reste résident.
+    def __init__(self, max_rooms: int, idle_s: float):
+        self.max_rooms, self.idle_s = max_rooms, idle_s
+        self._rooms: "OrderedDict[str, Room]" = OrderedDict()
+        self._joining: Dict[str, asyncio.Future] = {}
+        self._leaving: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def __iter__(self):
+        return iter(self._rooms.values())
+
+    def peek(self, name: str) -> Optional[Room]:
+        return self._rooms.get(name)
+
+    async def get(self, name: str) -> Room:
+        room = self._rooms.get(name)
+        if room is not None:
+            room.last = time.monotonic()
+            self._rooms.move_to_end(name)
+            return room
+        fut = self._joining.get(name)
+        if fut is None:
+            fut = self._joining[name] = asyncio.ensure_future(self._join(name))
+        return await asyncio.shield(fut)
 
-def canvas_as_text() -> str:
-    return "\n".join(canvas_as_lines())
+    async def _join(self, name: str) -> Room:
+        try:
+            leaving = self._leaving.get(name)
+            if leaving is not None: await leaving   # le leave précédent doit passer avant
+            await _broker.join(name)                # l'évènement "room" crée le miroir (loaded)
+            M_ROOM_JOINS.inc()
+            self._evict_over(keep=name)
+            return self._rooms[name]
+        finally:
+            self._joining.pop(name, None)
+
+    def loaded(self, ev: Dict[str, Any]):
+        name = ev["room"]
+        room = self._rooms.get(name)
+        if room is None:
+            room = self._rooms[name] = Room(name)
+        room.load(ev)
+
+    async def rejoin(self):
+        # reconnexion au hub: il ne connaît plus nos salons
+        for name in list(self._rooms):
+            try:
+                await _broker.join(name)
+            except BrokerUnavailable:
+                return
 
-async def canvas_set_cell(x: int, y: int, ch: str):
-    if not (0 <= x < CANVAS_W and 0 <= y < CANVAS_H): return
-    if not ch or len(ch) != 1: return
-    _canvas[y][x] = ch
+    def _evict(self, name: str):
+        room = self._rooms.pop(name)
+        _dirty_rooms.discard(room)
+        self._leaving[name] = asyncio.ensure_future(self._leave(name))
+        M_ROOM_EVICTIONS.inc()
 
-async def canvas_broadcast(msg: dict):
-    for q in list(_canvas_subs):
+    async def _leave(self, name: str):
         try:
-            q.put_nowait(msg)
-        except Exception:
-            pass
+            await _broker.leave(name)
+        finally:
+            self._leaving.pop(name, None)
+
+    def _evict_over(self, keep: str):
+        # plafond: les moins récents d'abord, jamais un salon écouté
+        d = self._rooms
+        if len(d) <= self.max_rooms: return
+        for name in list(d):
+            if len(d) <= self.max_rooms: break
+            if name in (ROOM_DEFAULT, keep) or d[name].subscribers(): continue
+            self._evict(name)
+
+    def sweep(self):
+        # de la tête (accès le plus ancien) jusqu'au premier salon récent;
+        # un salon encore écouté est re-daté et passe en queue
+        d, now = self._rooms, time.monotonic()
+        for _ in range(len(d)):
+            name, room = next(iter(d.items()))
+            if now - room.last < self.idle_s: break
+            if name == ROOM_DEFAULT or room.subscribers():
+                room.last = now
+                d.move_to_end(name)
+                continue
+            self._evict(name)
+
+_rooms = Rooms(MAX_ROOMS, ROOM_IDLE_S)
+
+async def room_sweeper():
+    while True:
+        await asyncio.sleep(max(1.0, ROOM_IDLE_S / 4))
+        _rooms.sweep()
+
+async def get_room(name: str) -> Room:
+    if not valid_room(name):
+        raise HTTPException(status_code=400, detail="bad room")
+    return await _rooms.get(name)
+
+def room_canvas(room: Room) -> "Canvas":
+    if room.canvas is None:
+        raise HTTPException(status_code=404, detail="no canvas in this room")
+    return room.canvas
 
 # --------------------------
-# Messages push & query
+# Évènements du backend -> état local + abonnés SSE
 # --------------------------
-def push_message_discussion(text: str, h: str):
-    global _next_id
-    msg = {"id": _next_id, "ts": now_s(), "chan":"discussion",
-           "text": text, "hash": h, "color": color_from_hash(h)}
-    _next_id += 1
-    _messages.append(msg)
-    for q in list(_subscribers):
-        try: q.put_nowait(msg)
-        except: pass
-
-def push_message_dessin(art: str, h: str):
-    global _next_id
-    msg = {"id": _next_id, "ts": now_s(), "chan":"dessin",
-           "art": art, "hash": h, "color": color_from_hash(h)}
-    _next_id += 1
-    _messages.append(msg)
-    for q in list(_subscribers):
-        try: q.put_nowait(msg)
-        except: pass
-
-def get_since(last_id: int, chan: str) -> List[Dict[str,Any]]:
-    if last_id < 0: last_id = 0
-    if chan not in CHANNELS: return []
-    out: List[Dict[str,Any]] = []
-    for m in _messages:
-        if m.get("chan") == chan and m["id"] > last_id:
-            out.append(m)
-            if len(out) >= POLL_BATCH: break
-    return out
+def on_broker_event(ev: dict):
+    kind = ev.get("ev")
+    if kind == "room":
+        _rooms.loaded(ev)
+        return
+    if kind == "hello":
+        if len(_rooms): asyncio.get_running_loop().create_task(_rooms.rejoin())
+        return
+    room = _rooms.peek(ev.get("room"))
+    if room is None: return   # salon évincé entre-temps
+    if kind == "msg":
+        msg = ev["msg"]
+        log = room.logs.get(msg["chan"])
+        if log is None: return
+        log.append(msg)
+        _hub.publish(room.keys[msg["chan"]], log.last_frame())
+    elif kind == "px":
+        if not ev["cells"] or room.canvas is None: return
+        room.canvas.set_cells(ev["cells"], ev["v"])
+        if room.canvas.dirty:
+            _dirty_rooms.add(room)
+            _canvas_dirty.set()
+
+# --------------------------
+# Messages push
+# --------------------------
+async def push_message_discussion(room: Room, text: str, h: str, color: str) -> dict:
+    t0 = time.perf_counter()
+    msg = await _broker.publish_msg(room.name, "discussion", {"text": text, "hash": h, "color": color})
+    M_PUBLISH.observe(time.perf_counter() - t0, "discussion")
+    return msg
+
+async def push_message_dessin(room: Room, art: str, h: str, color: str) -> dict:
+    t0 = time.perf_counter()
+    msg = await _broker.publish_msg(room.name, "dessin", {"art": art, "hash": h, "color": color})
+    M_PUBLISH.observe(time.perf_counter() - t0, "dessin")
+    return msg
+
+# --------------------------
+# Métriques (/metrics)
+# --------------------------
+# labels par channel (discussion, dessin, canvas), pas par salon: cardinalité fixe
+def _per_kind(fn):
+    return lambda: (((k,), fn(k)) for k in _hub.kinds())
+
+def _live(kind: str):
+    return [s for s in _hub.all() if s.kind == kind]
+
+M_PUBLISH = metrics.Histogram("picochan_publish_seconds",
+                              "push_message_* / canvas: aller-retour backend (id attribué)", ("chan",))
+M_FANOUT = metrics.Histogram("picochan_fanout_seconds", "Diffusion d'une frame à tous les abonnés", ("chan",),
+                             buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+M_RATE_LIMITED = metrics.Counter("picochan_rate_limited_total", "Requêtes refusées (429) par limite", ("route",))
+M_SSE_OPENED = metrics.Counter("picochan_sse_connections_opened_total", "Abonnements ouverts (SSE et /ws)", ("chan",))
+metrics.Gauge("picochan_sse_connections", "Abonnements ouverts en ce moment (SSE et /ws)", ("chan",),
+              fn=_per_kind(lambda k: _hub.kind_count[k]))
+M_WS = metrics.Gauge("picochan_ws_connections", "Connexions /ws ouvertes")
+M_WS_OPS = metrics.Counter("picochan_ws_ops_total", "Opérations reçues sur /ws", ("op",))
+metrics.Gauge("picochan_sse_queued_frames", "Frames en attente dans les files SSE", ("chan",),
+              fn=_per_kind(lambda k: sum(len(s.buf) for s in _live(k))))
+metrics.Gauge("picochan_sse_lag_max_seconds", "Retard du client SSE le plus en retard", ("chan",),
+              fn=_per_kind(lambda k: max([0.0] + [s.lag_s() for s in _live(k)])))
+metrics.Gauge("picochan_sse_queue_hwm", "Pic de file SSE depuis le démarrage", ("chan",),
+              fn=_per_kind(lambda k: max([_hub.closed_hwm.get(k, 0)] + [s.hwm for s in _live(k)])))
+metrics.Counter("picochan_sse_dropped_frames_total", "Frames jetées (client trop lent)", ("chan",),
+                fn=_per_kind(lambda k: _hub.closed_dropped.get(k, 0) + sum(s.dropped for s in _live(k))))
+metrics.Gauge("picochan_channel_messages", "Messages retenus par channel (salons résidents)", ("chan",),
+              fn=lambda: (((c,), sum(len(r.logs[c]) for r in _rooms)) for c in CHANNELS))
+metrics.Gauge("picochan_rooms", "Salons résidents", fn=lambda: [((), len(_rooms))])
+M_ROOM_JOINS = metrics.Counter("picochan_room_joins_total", "Salons chargés (join)")
+M_ROOM_EVICTIONS = metrics.Counter("picochan_room_evictions_total", "Salons évincés (leave)")
+metrics.Gauge("picochan_clients_active", "IP distinctes actives (approx.)", fn=lambda: [((), active_clients_count())])
+metrics.Gauge("picochan_process_info", "Process qui a répondu au scrape", ("pid", "backend"),
+              fn=lambda: [((os.getpid(), _broker.name), 1)])
 
 # --------------------------
 # FastAPI app
 # --------------------------
-app = FastAPI(title="Pico-Chan VPS")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _canvas_dirty
+    _canvas_dirty = asyncio.Event()   # avant start(): les évènements du backend le réveillent
+    await _broker.start(on_broker_event)
+    try:
+        await _rooms.get(ROOM_DEFAULT)
+    except BrokerUnavailable:
+        pass   # hub pas encore là: rejoint au premier accès
+    tasks = [asyncio.create_task(canvas_ticker(_canvas_dirty)), asyncio.create_task(metrics.sample_loop_lag()),
+             asyncio.create_task(room_sweeper())]
+    try:
+        yield
+    finally:
+        for t in tasks: t.cancel()
+        await _broker.stop()
+
+app = FastAPI(title="Pico-Chan VPS", lifespan=lifespan)
+app.add_middleware(metrics.HttpMetrics)
+
+@app.exception_handler(BrokerUnavailable)
+async def broker_unavailable(request: Request, exc: BrokerUnavailable):
+    return JSONResponse({"detail": "backend unavailable"}, status_code=503)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Page d'accueil: ne dépend que de réglages fixés au démarrage -> rendue une fois,
+# compressée une fois (gzip, + br si le module brotli est installé). Redémarrer après
+# une modification du template.
+def render_index() -> Dict[str, Tuple[bytes, str]]:
+    html = templates.get_template("index.html").render(
+        title=TITLE, maxlen=MAX_TEXT, maxmsgs=MAX_MSGS,
+        canvas_w=CANVAS_W, canvas_h=CANVAS_H, ws=WS_ENABLED, room_canvas=ROOM_CANVAS,
+    ).encode()
+    tag = hashlib.sha1(html).hexdigest()[:16]
+    out = {"identity": (html, '"%s"' % tag), "gzip": (gzip.compress(html, 9, mtime=0), '"%s-gz"' % tag)}
+    if brotli is not None:
+        out["br"] = (brotli.compress(html, quality=11), '"%s-br"' % tag)
+    return out
+
+def pick_encoding(accept: str, available) -> str:
+    # préférence serveur br > gzip parmi ce que le client accepte (q=0 = refusé)
+    accepted = set()
+    for part in accept.lower().split(","):
+        name, _, q = part.partition(";")
+        q = q.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0: continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    for enc in ("br", "gzip"):
+        if enc in available and (enc in accepted or "*" in accepted): return enc
+    return "identity"
+
+_index = render_index()
+_CHANNELS_BODY = codec.dumps(list(CHANNELS))
+_OK_BODY = codec.dumps({"ok": True})
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "title": TITLE,
-        "maxlen": MAX_TEXT,
-        "maxmsgs": MAX_MSGS,
-    })
+    enc = pick_encoding(request.headers.get("accept-encoding", ""), _index)
+    body, etag = _index[enc]
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if enc != "identity": headers["Content-Encoding"] = enc
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
 
 @app.get("/healthz")
 async def healthz():
-    return {
+    return FastJSONResponse({
         "ok": True,
         "clients_active": active_clients_count(),
-        "msgs": len(_messages),
-        "hash_rotate_daily": HASH_ROTATE_DAILY
-    }
+        "msgs": sum(len(log) for room in _rooms for log in room.logs.values()),
+        "rooms": len(_rooms),
+        "hash_rotate_daily": HASH_ROTATE_DAILY,
+        "backend": _broker.name,
+        "json": codec.NAME,
+    })
+
+async def healthz_subs(limit: int = 50):
+    # les connexions les plus en retard (SSE et /ws): retard, frames perdues, pic de file.
+    # Vue de diagnostic, désactivée par défaut (les agrégats sont dans /metrics)
+    limit = max(1, min(limit, SUBS_LIST_MAX))
+    worst = heapq.nlargest(limit, _hub.all(), key=lambda s: (len(s.buf), s.dropped))
+    return FastJSONResponse([sub.stats() for sub in worst])
+
+if HEALTHZ_SUBS:
+    app.add_api_route("/healthz/subs", healthz_subs, methods=["GET"])
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/channels")
 async def channels():
-    return list(CHANNELS)
+    return FastJSONResponse(_CHANNELS_BODY)
 
 # -------- Fil de messages (channels) --------
 @app.get("/poll")
-async def poll(request: Request, last_id: int = 0, chan: str = "discussion"):
-    ip = client_ip(request); _clients[ip] = now_s()
-    return get_since(last_id, chan)
+async def poll(request: Request, last_id: int = 0, chan: str = "discussion", room: str = ROOM_DEFAULT):
+    touch_client(request)
+    log = (await get_room(room)).logs.get(chan)
+    if log is None:
+        return Response(content=b"[]", media_type="application/json")
+    body, etag = log.poll_payload(max(last_id, 0), POLL_BATCH)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/stream")
-async def stream(request: Request, chan: str = "discussion"):
+async def stream(request: Request, chan: str = "discussion", last_id: int = -1, room: str = ROOM_DEFAULT):
     if chan not in CHANNELS:
         raise HTTPException(status_code=400, detail="unknown channel")
-    ip = client_ip(request); _clients[ip] = now_s()
-
-    queue: asyncio.Queue = asyncio.Queue()
-    _subscribers.append(queue)
+    ip = touch_client(request)
+    subscribe_limit(ip)
+    r = await get_room(room)
 
-    async def event_generator():
-        try:
-            # PAS d'historique ici -> évite les doublons avec /poll
-            while True:
-                if await request.is_disconnected(): break
-                try:
-                    msg = await asyncio.wait_for(queue.get(), timeout=15.0)
-                    if msg.get("chan") == chan:
-                        yield ("data: " + jdump(msg) + "\n\n")
-                except asyncio.TimeoutError:
-                    yield "event: ping\ndata: {}\n\n"
-        finally:
-            if queue in _subscribers:
-                _subscribers.remove(queue)
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    # historique seulement sur demande (last_id >= 0 ou Last-Event-ID) -> pas de doublons avec /poll
+    log = r.logs[chan]
+    since = last_event_id(request, last_id)
+    first = (lambda: log.frames_since(since)) if since >= 0 else None
+    return StreamingResponse(sse_pump(r.keys[chan], ip, SSE_OVERFLOW, first), media_type="text/event-stream")
 
 @app.post("/msg")
-async def post_msg(request: Request, text: str = Form(...), chan: str = Form("discussion")):
+async def post_msg(request: Request, text: str = Form(...), chan: str = Form("discussion"),
+                   room: str = Form(ROOM_DEFAULT)):
     if chan != "discussion":
         raise HTTPException(status_code=400, detail="use /dessin/* for canvas")
-    ip = client_ip(request); tnow = time.time(); _clients[ip] = now_s()
-
-    # rate limit
-    last = _last_post.get(ip, 0.0)
-    if (tnow - last) < POST_COOLDOWN:
-        raise HTTPException(status_code=429, detail="slow down")
-    _last_post[ip] = tnow
+    ip = touch_client(request)
+    rate_limit("msg", ip)
+    await post_discussion(await get_room(room), ip, text)
+    return Response(status_code=204)  # No Content (aucun corps)
 
+async def post_discussion(room: Room, ip: str, text: Any):
     # sanitize
-    text = (text or "").strip().replace("\r\n", "\n")
+    text = (text if isinstance(text, str) else "").strip().replace("\r\n", "\n")
     if not text:
         raise HTTPException(status_code=400, detail="empty")
     if len(text) > MAX_TEXT:
         text = text[:MAX_TEXT]
 
-    h = anon_hash_for_ip(ip, int(tnow))
-    push_message_discussion(text, h)
-    return Response(status_code=204)  # No Content (aucun corps)
+    h, color = client_identity(ip, now_s())
+    await push_message_discussion(room, text, h, color)
 
-# -------- Canvas 24x8 (dessin) --------
+# -------- Canvas (dessin) --------
 class Pix(BaseModel):
     x: int
     y: int
@@ -267,58 +907,186 @@ class DiffReq(BaseModel):
     pixels: List[Pix]
 
 @app.get("/dessin/canvas")
-async def dessin_canvas():
-    # état actuel (8 lignes de 24 colonnes)
-    return {"w": CANVAS_W, "h": CANVAS_H, "lines": canvas_as_lines()}
+async def dessin_canvas(room: str = ROOM_DEFAULT):
+    # état actuel (h lignes de w colonnes)
+    return FastJSONResponse(room_canvas(await get_room(room)).json_body())
 
 @app.get("/dessin/stream")
-async def dessin_stream(request: Request):
-    ip = client_ip(request); _clients[ip] = now_s()
-    queue: asyncio.Queue = asyncio.Queue()
-    _canvas_subs.append(queue)
-
-    async def gen():
-        try:
-            # full state initial
-            await queue.put({"full": {"w": CANVAS_W, "h": CANVAS_H, "lines": canvas_as_lines()}})
-            while True:
-                if await request.is_disconnected(): break
-                try:
-                    msg = await asyncio.wait_for(queue.get(), timeout=15.0)
-                    yield "data: " + jdump(msg) + "\n\n"
-                except asyncio.TimeoutError:
-                    yield "event: ping\ndata: {}\n\n"
-        finally:
-            if queue in _canvas_subs:
-                _canvas_subs.remove(queue)
-
-    return StreamingResponse(gen(), media_type="text/event-stream")
+async def dessin_stream(request: Request, v: int = -1, room: str = ROOM_DEFAULT):
+    ip = touch_client(request)
+    subscribe_limit(ip)
+    r = await get_room(room)
+    canvas = room_canvas(r)
+    # full state initial, ou seulement les diffs manqués si on connaît la version du client
+    since = last_event_id(request, v)
+    first = (lambda: canvas.frames_since(since)) if since >= 0 else canvas.full_frame
+    gen = sse_pump(r.keys["canvas"], ip, CANVAS_OVERFLOW, first, resync=canvas.full_frame)
+    return StreamingResponse(gen, media_type="text/event-stream")
 
 @app.post("/dessin/diff")
-async def dessin_diff(req: DiffReq, request: Request):
-    ip = client_ip(request); tnow = time.time(); _clients[ip] = now_s()
+async def dessin_diff(req: DiffReq, request: Request, room: str = ROOM_DEFAULT):
+    ip = touch_client(request)
+    rate_limit("diff", ip)
     if len(req.pixels) > 256:
         raise HTTPException(status_code=400, detail="too many pixels")
-    async with _canvas_lock:
-        for p in req.pixels:
-            await canvas_set_cell(p.x, p.y, p.ch)
-    # broadcast par pixel
-    for p in req.pixels:
-        await canvas_broadcast({"x": p.x, "y": p.y, "ch": p.ch})
-    return {"ok": True, "n": len(req.pixels)}
+    r = await get_room(room)
+    room_canvas(r)
+    async with r.lock:
+        await canvas_set_cells(r, [[p.x, p.y, p.ch] for p in req.pixels])
+    return FastJSONResponse({"ok": True, "n": len(req.pixels)})
 
 @app.post("/dessin/publish")
-async def dessin_publish(request: Request):
-    ip = client_ip(request); tnow = time.time(); _clients[ip] = now_s()
+async def dessin_publish(request: Request, room: str = ROOM_DEFAULT):
+    ip = touch_client(request)
+    rate_limit("publish", ip)
+    await publish_canvas(await get_room(room), ip)
+    return FastJSONResponse(_OK_BODY)
 
-    # Reuse du rate-limit "post"
-    last = _last_post.get(ip, 0.0)
-    if (tnow - last) < POST_COOLDOWN:
-        raise HTTPException(status_code=429, detail="slow down")
-    _last_post[ip] = tnow
+async def publish_canvas(room: Room, ip: str):
+    h, color = client_identity(ip, now_s())
+    canvas = room_canvas(room)
+    async with room.lock:
+        art = canvas.text()  # h lignes * w colonnes
+    await push_message_dessin(room, art, h, color)
+
+# -------- WebSocket multiplexé --------
+# Client -> serveur, un objet JSON par message:
+#   {"op":"sub","room":R,"chan":"discussion"|"dessin"|"canvas","since":N}  (last_id / version; -1 = live seul, full pour le canvas)
+#   {"op":"unsub","room":R,"chan":...}
+#   {"op":"px","room":R,"i":[y*w+x,...],"ch":"..."}   un caractère par indice (même codage que les diffs descendants)
+#   {"op":"msg","room":R,"text":"..."}   {"op":"publish","room":R}
+# "room" absent = salon par défaut. Serveur -> client, messages binaires "<salon>/<chan>\n<frames SSE>":
+# les bytes déjà encodés du fan-out, préfixés de la clé; clé "!" = erreur d'une opération ({"op","status","detail"}).
+WS_MAX_PIXELS = 256
+WS_ROUTES = {"sub": "sub", "px": "diff", "msg": "msg", "publish": "publish"}   # op -> limite
+
+def ws_cells(o: Dict[str, Any]) -> List[List[Any]]:
+    # pas de modèle Pydantic par pixel: contrôle de forme ici, bornes dans clean_cells()
+    idx, chars = o.get("i"), o.get("ch")
+    if not isinstance(idx, list) or not isinstance(chars, str) or len(idx) != len(chars):
+        raise HTTPException(status_code=400, detail="bad pixels")
+    if len(idx) > WS_MAX_PIXELS:
+        raise HTTPException(status_code=400, detail="too many pixels")
+    w = CANVAS_W
+    return [[i % w, i // w, c] for i, c in zip(idx, chars) if type(i) is int and i >= 0]
+
+class WsConn:
+    # Une connexion /ws: une tâche par abonnement (clé de fan-out -> pump), envois sérialisés par un verrou.
+    def __init__(self, ws: WebSocket, ip: str):
+        self.ws, self.ip = ws, ip
+        self.pumps: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, data: bytes):
+        async with self._send_lock:
+            await self.ws.send_bytes(data)
+
+    async def _pump(self, key: str, policy: str, first, resync):
+        # même contrat que sse_pump(): abonnement puis first() sans await entre les deux
+        sub = _hub.subscribe(key, self.ip, policy, resync)
+        head = key.encode() + b"\n"
+        try:
+            chunk = first() if first is not None else b""
+            while chunk is not None:
+                if chunk: await self.send(head + chunk)
+                chunk = await sub.get(SSE_PING_S)
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            return
+        finally:
+            _hub.unsubscribe(sub)
+        # coupé pour lenteur: le client se reconnecte et reprend depuis ses since
+        try: await self.ws.close(code=1013)
+        except (RuntimeError, OSError): pass
+
+    def sub(self, room: Room, chan: str, since: int):
+        if chan in CHANNELS:
+            log = room.logs[chan]
+            first = (lambda: log.frames_since(since)) if since >= 0 else None
+            policy, resync = SSE_OVERFLOW, None
+        elif chan == "canvas":
+            canvas = room_canvas(room)
+            first = (lambda: canvas.frames_since(since)) if since >= 0 else canvas.full_frame
+            policy, resync = CANVAS_OVERFLOW, canvas.full_frame
+        else:
+            raise HTTPException(status_code=400, detail="unknown channel")
+        key = room.keys[chan]
+        self.unsub(key)
+        self.pumps[key] = asyncio.create_task(self._pump(key, policy, first, resync))
+
+    def unsub(self, key: str):
+        task = self.pumps.pop(key, None)
+        if task: task.cancel()
+
+    async def handle(self, o: Dict[str, Any]):
+        op = o.get("op")
+        _presence.add(self.ip)
+        name = o.get("room", ROOM_DEFAULT)
+        if op == "unsub":
+            # sans join: un salon évincé n'a plus d'abonné de toute façon
+            if not valid_room(name): raise HTTPException(status_code=400, detail="bad room")
+            self.unsub(name + "/" + str(o.get("chan")))
+            M_WS_OPS.inc(op)
+            return
+        if op not in WS_ROUTES:
+            raise HTTPException(status_code=400, detail="unknown op")
+        # limites avant le join du salon
+        if op == "sub":
+            chan = str(o.get("chan"))
+            if chan not in CHANNELS and chan != "canvas":
+                raise HTTPException(status_code=400, detail="unknown channel")
+            if valid_room(name) and name + "/" + chan not in self.pumps:
+                if len(self.pumps) >= WS_MAX_SUBS:
+                    raise HTTPException(status_code=429, detail="too many subscriptions")
+                subscribe_limit(self.ip)
+            else:
+                rate_limit("sub", self.ip)
+        else:
+            rate_limit(WS_ROUTES[op], self.ip)
+        room = await get_room(name)
+        if op == "sub":
+            self.sub(room, chan, int(o.get("since", -1)))
+        elif op == "px":
+            cells = ws_cells(o)
+            room_canvas(room)
+            async with room.lock:
+                await canvas_set_cells(room, cells)
+        elif op == "msg":
+            await post_discussion(room, self.ip, o.get("text"))
+        else:
+            await publish_canvas(room, self.ip)
+        M_WS_OPS.inc(op)
+
+    def close(self):
+        for key in list(self.pumps): self.unsub(key)
+
+async def ws_endpoint(ws: WebSocket):
+    await ws.accept()
+    conn = WsConn(ws, touch_client(ws))
+    M_WS.inc()
+    try:
+        while True:
+            m = await ws.receive()
+            if m["type"] == "websocket.disconnect": break
+            op = None
+            try:
+                o = codec.loads(m.get("text") or m.get("bytes") or b"")
+                if not isinstance(o, dict): raise ValueError("not an object")
+                op = o.get("op")
+                await conn.handle(o)
+            except HTTPException as e:
+                err = {"op": op, "status": e.status_code, "detail": e.detail}
+            except BrokerUnavailable:
+                err = {"op": op, "status": 503, "detail": "backend unavailable"}
+            except (ValueError, TypeError):
+                err = {"op": op, "status": 400, "detail": "bad request"}
+            else:
+                continue
+            await conn.send(b"!\n" + sse_frame(err))
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        pass
+    finally:
+        conn.close()
+        M_WS.inc(n=-1)
 
-    h = anon_hash_for_ip(ip, int(tnow))
-    async with _canvas_lock:
-        art = canvas_as_text()  # 8 lignes * 24 colonnes
-    push_message_dessin(art, h)
-    return {"ok": True}
+if WS_ENABLED:
+    app.add_api_websocket_route("/ws", ws_endpoint)
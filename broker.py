@@ -0,0 +1,413 @@
+# broker.py — état partagé + pub/sub de Pico-Chan (backends interchangeables)
+#
+#   LocalBroker : un seul process (uvicorn seul, ou gunicorn avec 1 worker)
+#   HubBroker   : N workers gunicorn reliés à un hub sur socket Unix.
+#                 Le hub attribue les ids (ordre par salon), garde l'historique
+#                 et le canvas des salons, et rediffuse chaque évènement aux workers
+#                 qui ont rejoint le salon. Chaque worker garde un miroir local des salons
+#                 qu'il sert -> /poll, /dessin/canvas restent des lectures locales.
+#
+# Les deux backends exposent la même interface:
+#   await start(on_event) / await stop()
+#   await join(room)  -> l'état du salon arrive par on_event ("room") avant le retour
+#   await leave(room)    plus d'évènements pour ce salon; évincé s'il n'a plus de membre
+#   await publish_msg(room, chan, fields) -> msg   (id + ts attribués par le backend)
+#   await publish_cells(room, [[x, y, ch], ...])
+# et rappellent on_event(ev) pour chaque évènement validé, dans l'ordre du salon:
+#   {"ev":"hello"}                                         (connexion au hub: refaire les join)
+#   {"ev":"room", "room", "msgs":[...], "lines", "v"}      (état complet; lines = None sans canvas)
+#   {"ev":"msg",  "room", "msg":{id, ts, chan, ...}}
+#   {"ev":"px",   "room", "cells":[[x, y, ch], ...], "v"}  (v: version du canvas après le lot)
+#
+# Protocole hub <-> worker: une ligne JSON par op/évènement.
+#   worker -> hub : {"op":"join"|"leave", "rid", "room"}
+#                   {"op":"msg", "rid", "room", "chan", "fields"} | {"op":"px", "rid", "room", "cells"}
+#   hub -> worker : les évènements ci-dessus, "rid" recopié pour l'accusé de réception;
+#                   {"ev":"err", "rid", "detail"} si l'op est refusée
+#
+# Persistance (PICOCHAN_DATA_DIR, cf. store.py): tenue par LocalBroker ou par le hub,
+# un salon est relu du disque quand il est chargé et refermé (snapshot) quand il est évincé.
+#
+# Hub autonome:  python broker.py [SOCK_PATH]
+
+import os, sys, time, asyncio, signal
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+import codec
+from rooms import ROOM_DEFAULT, ROOM_TTL_S, MAX_ROOM_DIRS, valid_room, retention, has_canvas, canvas_size
+from store import Store, Stores, open_stores
+
+EventCallback = Callable[[Dict[str, Any]], None]
+
+HUB_SOCK = os.getenv("PICOCHAN_HUB_SOCK", "/tmp/picochan-hub.sock")
+HUB_TIMEOUT = 5.0
+HUB_LINE_LIMIT = 16 * 1024 * 1024     # l'état d'un salon tient sur une ligne
+HUB_MAX_BACKLOG = 8 * 1024 * 1024     # worker trop lent -> déconnecté (il se resynchronise)
+
+def _dump(o) -> bytes:
+    return codec.dumps(o) + b"\n"
+
+class BrokerUnavailable(Exception):
+    pass
+
+def clean_cells(cells, w: int, h: int) -> List[List[Any]]:
+    out = []
+    for c in cells:
+        try:
+            x, y, ch = int(c[0]), int(c[1]), c[2]
+        except (TypeError, ValueError, IndexError):
+            continue
+        if not (0 <= x < w and 0 <= y < h): continue
+        if not isinstance(ch, str) or len(ch) != 1: continue
+        out.append([x, y, ch])
+    return out
+
+# --------------------------
+# État d'un salon (détenteur: LocalBroker ou hub)
+# --------------------------
+def id_floor() -> int:
+    # Les ids ne doivent jamais repartir en arrière (dédoublonnage des clients, reprise
+    # Last-Event-ID), y compris quand l'état est perdu: hub relancé sans persistance,
+    # fenêtre de group commit non écrite. Plancher = horloge en ms (tient tant que le débit
+    # moyen d'un salon reste sous 1000 messages/s; < 2^53, sûr en JavaScript).
+    return int(time.time() * 1000)
+
+class RoomState:
+    __slots__ = ("name", "next_id", "msgs", "w", "h", "canvas", "v")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.next_id = id_floor()
+        self.msgs: Dict[str, Deque[Dict[str, Any]]] = {}   # chan -> historique retenu
+        self.w, self.h = canvas_size() if has_canvas(name) else (0, 0)
+        self.canvas = [[" "] * self.w for _ in range(self.h)]
+        self.v = 0
+
+    def restore(self, st: Dict[str, Any]):
+        self.next_id, self.v = max(st["next_id"], id_floor()), st["v"]
+        for m in st["msgs"]: self.retain(m)
+        for y, line in enumerate((st["lines"] or [])[:self.h]):
+            self.canvas[y] = list(line[:self.w].ljust(self.w))
+
+    def retain(self, msg: Dict[str, Any]):
+        hist = self.msgs.get(msg["chan"])
+        if hist is None:
+            hist = self.msgs[msg["chan"]] = deque(maxlen=retention(self.name, msg["chan"]))
+        hist.append(msg)
+
+    def snapshot(self) -> Dict[str, Any]:
+        msgs = sorted((m for d in self.msgs.values() for m in d), key=lambda m: m["id"])
+        lines = ["".join(row) for row in self.canvas] if self.w else None
+        return {"ev": "room", "room": self.name, "msgs": msgs, "lines": lines, "v": self.v}
+
+    def add_msg(self, chan: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        msg = {"id": self.next_id, "ts": int(time.time()), "chan": chan, **fields}
+        self.next_id += 1
+        self.retain(msg)
+        return msg
+
+    def add_cells(self, cells) -> List[List[Any]]:
+        cells = clean_cells(cells, self.w, self.h)
+        for x, y, ch in cells:
+            self.canvas[y][x] = ch
+        if cells: self.v += 1
+        return cells
+
+class RoomHost:
+    # Salons résidents du détenteur de l'état, chargés à la demande (depuis le disque si
+    # persistance), un seul chargement en vol par salon.
+    def __init__(self, stores: Optional[Stores] = None):
+        self.rooms: Dict[str, RoomState] = {}
+        self.stores = stores
+        self._stores: Dict[str, Store] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    async def room(self, name: str) -> RoomState:
+        rs = self.rooms.get(name)
+        if rs is not None: return rs
+        fut = self._loading.get(name)
+        if fut is None:
+            fut = self._loading[name] = asyncio.ensure_future(self._load(name))
+        return await asyncio.shield(fut)
+
+    async def _load(self, name: str) -> RoomState:
+        try:
+            rs = RoomState(name)
+            if self.stores:
+                self._stores[name], st = await self.stores.open(name)
+                rs.restore(st)
+            self.rooms[name] = rs
+            return rs
+        finally:
+            self._loading.pop(name, None)
+
+    async def unload(self, name: str):
+        if name == ROOM_DEFAULT or self.rooms.pop(name, None) is None: return
+        self._stores.pop(name, None)
+        if self.stores: await self.stores.close(name)
+
+    def add_msg(self, rs: RoomState, chan: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        msg = rs.add_msg(chan, fields)
+        st = self._stores.get(rs.name)
+        if st: st.append_msg(msg)
+        return msg
+
+    def add_cells(self, rs: RoomState, cells) -> List[List[Any]]:
+        cells = rs.add_cells(cells)
+        st = self._stores.get(rs.name)
+        if st and cells: st.append_cells(cells, rs.v)
+        return cells
+
+# --------------------------
+# Mono-process
+# --------------------------
+class LocalBroker(RoomHost):
+    name = "local"
+
+    def __init__(self, stores: Optional[Stores] = None):
+        super().__init__(stores)
+        self._on_event: Optional[EventCallback] = None
+
+    async def start(self, on_event: EventCallback):
+        self._on_event = on_event
+        if self.stores: await self.stores.start()
+
+    async def stop(self):
+        self._on_event = None
+        if self.stores: await self.stores.stop()
+
+    async def join(self, room: str):
+        rs = await self.room(room)
+        if self._on_event: self._on_event(rs.snapshot())
+
+    async def leave(self, room: str):
+        await self.unload(room)
+
+    async def publish_msg(self, room: str, chan: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        msg = self.add_msg(await self.room(room), chan, fields)
+        if self._on_event: self._on_event({"ev": "msg", "room": room, "msg": msg})
+        return msg
+
+    async def publish_cells(self, room: str, cells: List[List[Any]]):
+        if not cells: return
+        rs = await self.room(room)
+        cells = self.add_cells(rs, cells)
+        if cells and self._on_event: self._on_event({"ev": "px", "room": room, "cells": cells, "v": rs.v})
+
+# --------------------------
+# Multi-process: client (côté worker)
+# --------------------------
+class HubBroker:
+    name = "hub"
+
+    def __init__(self, path: str = HUB_SOCK, timeout: float = HUB_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._on_event: Optional[EventCallback] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._ready: Optional[asyncio.Event] = None   # créé dans start(): boucle de service (py < 3.10)
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._tag = f"{os.getpid()}"
+        self._seq = 0
+
+    async def start(self, on_event: EventCallback):
+        self._on_event = on_event
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        # on attend la connexion pour ne pas servir un état vide;
+        # si le hub n'est pas là, le worker démarre quand même (503 sur les posts)
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except (asyncio.CancelledError, Exception): pass
+            self._task = None
+
+    async def _run(self):
+        delay = 0.2
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=HUB_LINE_LIMIT)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                continue
+            delay = 0.2
+            self._writer = writer
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line: break
+                    ev = codec.loads(line)
+                    kind = ev.get("ev")
+                    if kind == "hello": self._ready.set()
+                    if self._on_event and kind != "err": self._on_event(ev)
+                    fut = self._pending.pop(ev.get("rid") or "", None)
+                    if fut and not fut.done():
+                        if kind == "err": fut.set_exception(BrokerUnavailable(ev.get("detail") or "refused"))
+                        else: fut.set_result(ev)
+            except (OSError, ValueError):
+                pass
+            finally:
+                self._writer = None
+                self._ready.clear()
+                writer.close()
+                for fut in self._pending.values():
+                    if not fut.done(): fut.set_exception(BrokerUnavailable("hub disconnected"))
+                self._pending.clear()
+
+    async def _request(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        if self._writer is None:
+            raise BrokerUnavailable("hub unreachable")
+        self._seq += 1
+        rid = op["rid"] = f"{self._tag}:{self._seq}"
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        self._writer.write(_dump(op))
+        try:
+            # l'évènement est déjà appliqué au miroir local quand fut se résout
+            return await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(rid, None)
+            raise BrokerUnavailable("hub timeout")
+
+    async def join(self, room: str):
+        await self._request({"op": "join", "room": room})
+
+    async def leave(self, room: str):
+        # sans accusé: le hub traite les ops d'un worker dans l'ordre
+        if self._writer is not None:
+            self._writer.write(_dump({"op": "leave", "room": room}))
+
+    async def publish_msg(self, room: str, chan: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+        ev = await self._request({"op": "msg", "room": room, "chan": chan, "fields": fields})
+        return ev["msg"]
+
+    async def publish_cells(self, room: str, cells: List[List[Any]]):
+        await self._request({"op": "px", "room": room, "cells": cells})
+
+# --------------------------
+# Multi-process: hub (process dédié)
+# --------------------------
+class Hub(RoomHost):
+    # Un salon reste chargé tant qu'un worker l'a rejoint; les évènements ne partent
+    # qu'aux membres (+ le demandeur pour son accusé) -> coût par salon actif seulement.
+    def __init__(self, stores: Optional[Stores] = None):
+        super().__init__(stores)
+        self.conns: set = set()
+        self.members: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.joined: Dict[asyncio.StreamWriter, Set[str]] = {}
+
+    async def _leave(self, writer, room: str):
+        self.joined.get(writer, set()).discard(room)
+        members = self.members.get(room)
+        if members is not None:
+            members.discard(writer)
+            if members: return
+            del self.members[room]
+        await self.unload(room)
+
+    async def apply(self, op: Dict[str, Any], writer) -> Optional[Dict[str, Any]]:
+        kind, room, rid = op.get("op"), op.get("room"), op.get("rid")
+        if not valid_room(room):
+            return {"ev": "err", "rid": rid, "detail": "bad room"} if rid else None
+        if kind == "leave":
+            await self._leave(writer, room)
+            return None
+        rs = await self.room(room)
+        if kind == "join":
+            self.members.setdefault(room, set()).add(writer)
+            self.joined.setdefault(writer, set()).add(room)
+            ev = rs.snapshot()
+            ev["rid"] = rid
+            writer.write(_dump(ev))
+            return None
+        if kind == "msg":
+            chan, fields = op.get("chan"), op.get("fields")
+            if isinstance(chan, str) and isinstance(fields, dict):
+                ev = {"ev": "msg", "room": room, "rid": rid, "msg": self.add_msg(rs, chan, fields)}
+            else:
+                ev = {"ev": "err", "rid": rid, "detail": "bad msg"}
+        elif kind == "px":
+            ev = {"ev": "px", "room": room, "rid": rid, "cells": self.add_cells(rs, op.get("cells") or []), "v": rs.v}
+        else:
+            ev = {"ev": "err", "rid": rid, "detail": "unknown op"}
+        if room not in self.members:
+            await self.unload(room)   # chargé pour un worker non membre: rien à garder
+        return ev
+
+    def broadcast(self, ev: Dict[str, Any], origin):
+        data = _dump(ev)   # encodé une seule fois pour tous les workers
+        targets = self.members.get(ev.get("room"), ()) if ev.get("ev") != "err" else ()
+        for w in list(targets):
+            self._write(w, data)
+        if origin not in targets: self._write(origin, data)
+
+    def _write(self, w, data: bytes):
+        if w.transport.get_write_buffer_size() > HUB_MAX_BACKLOG:
+            self.conns.discard(w)
+            w.close()
+            return
+        w.write(data)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.conns.add(writer)
+        writer.write(_dump({"ev": "hello"}))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                try:
+                    op = codec.loads(line)
+                except ValueError:
+                    continue
+                ev = await self.apply(op, writer)
+                if ev: self.broadcast(ev, writer)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.conns.discard(writer)
+            for room in list(self.joined.pop(writer, ())):
+                await self._leave(writer, room)
+            writer.close()
+
+    async def serve(self, path: str):
+        if os.path.exists(path): os.unlink(path)
+        if self.stores: await self.stores.start()   # avant les connexions (join -> stores.open)
+        server = await asyncio.start_unix_server(self.handle, path=path, limit=HUB_LINE_LIMIT)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        async with server:
+            await stop.wait()
+        if self.stores: await self.stores.stop()
+        if os.path.exists(path): os.unlink(path)
+
+def _room_store(room: str, path: str) -> Store:
+    w, h = canvas_size() if has_canvas(room) else (0, 0)
+    return Store(path, w, h, retention(room, None), lambda chan: retention(room, chan))
+
+def _open_stores() -> Optional[Stores]:
+    return open_stores(_room_store, ROOM_DEFAULT, ROOM_TTL_S, MAX_ROOM_DIRS)
+
+def run_hub(path: str = HUB_SOCK):
+    async def main():
+        await Hub(stores=_open_stores()).serve(path)
+    asyncio.run(main())
+
+def make_broker(kind: str, path: str = HUB_SOCK):
+    # en mode hub, seul le hub persiste; les workers ne sont que des miroirs
+    if kind == "hub": return HubBroker(path)
+    if kind == "local": return LocalBroker(_open_stores())
+    raise ValueError(f"unknown PICOCHAN_BACKEND: {kind}")
+
+if __name__ == "__main__":
+    run_hub(sys.argv[1] if len(sys.argv) > 1 else HUB_SOCK)
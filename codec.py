@@ -0,0 +1,23 @@
+# codec.py — JSON compact de Pico-Chan: orjson s'il est installé, sinon json standard
+#
+#   dumps(o) -> bytes UTF-8 sans espaces (orjson n'échappe pas le non-ASCII: frames plus courtes)
+#   loads(bytes | str)
+# Les deux sorties se relisent l'une l'autre: workers, hub et journaux disque peuvent mélanger.
+
+import json as _json
+
+try:
+    import orjson
+except ImportError:   # optionnel (pip install orjson)
+    orjson = None
+
+NAME = "orjson" if orjson is not None else "json"
+
+if orjson is not None:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+    def dumps(o) -> bytes:
+        return _json.dumps(o, separators=(",",":"), ensure_ascii=False).encode()
+
+    loads = _json.loads
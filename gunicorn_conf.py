@@ -1,8 +1,66 @@
+import os, sys, threading, traceback, multiprocessing
+from multiprocessing.connection import wait as mp_wait
+
 bind = "127.0.0.1:8080"
-workers = 2
+workers = int(os.getenv("PICOCHAN_WORKERS", "2"))
 worker_class = "uvicorn.workers.UvicornWorker"
 timeout = 60
 graceful_timeout = 30
 keepalive = 15
 accesslog = "-"
-errorlog = "-"
\ No newline at end of file
+errorlog = "-"
+
+# Plusieurs workers -> état partagé via le hub (broker.py), lancé et surveillé par le master
+HUB_RESPAWN_S = 1.0   # délai avant de relancer un hub mort (crash, OOM)
+
+_hub = None
+_stopping = threading.Event()
+
+def _hub_main(path):
+    # l'arbitre récolte aussi ce process (waitpid(-1)) et s'arrête sur les codes 3/4
+    # (boot/chargement d'un worker): le hub ne sort qu'avec 0 ou 1
+    from broker import run_hub
+    try:
+        run_hub(path)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+def _spawn_hub():
+    from broker import HUB_SOCK
+    p = multiprocessing.Process(target=_hub_main, name="picochan-hub", daemon=True, args=(HUB_SOCK,))
+    p.start()
+    return p
+
+def _watch_hub(server):
+    # is_alive()/exitcode ne voient pas la mort d'un process déjà récolté par l'arbitre;
+    # le sentinel (fin de pipe tenue par l'enfant) devient lisible à sa sortie dans tous les cas.
+    # Les workers se reconnectent seuls (HubBroker._run) et re-rejoignent leurs salons.
+    global _hub
+    while not _stopping.is_set():
+        if not mp_wait([_hub.sentinel], 0.5) or _stopping.is_set(): continue
+        server.log.error("picochan-hub (pid %s) exited, respawning", _hub.pid)
+        _stopping.wait(HUB_RESPAWN_S)
+        if not _stopping.is_set(): _hub = _spawn_hub()
+
+def on_starting(server):
+    global _hub
+    n = server.cfg.workers   # valeur effective (-w l'emporte sur PICOCHAN_WORKERS)
+    if n > 1:
+        os.environ.setdefault("PICOCHAN_BACKEND", "hub")
+        if os.environ["PICOCHAN_BACKEND"] != "hub":
+            # chaque worker aurait son propre état (ids, historique) et écrirait dans les mêmes segments
+            server.log.error("PICOCHAN_BACKEND=%s avec %d workers: utiliser hub (ou 1 worker)",
+                             os.environ["PICOCHAN_BACKEND"], n)
+            sys.exit(1)
+    if os.getenv("PICOCHAN_BACKEND") != "hub":
+        return
+    _hub = _spawn_hub()
+    threading.Thread(target=_watch_hub, args=(server,), name="picochan-hub-watch", daemon=True).start()
+
+def on_exit(server):
+    _stopping.set()
+    if _hub is not None and _hub.is_alive():
+        _hub.terminate()
+        _hub.join(5)
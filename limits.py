@@ -0,0 +1,110 @@
+# limits.py — rate limit et présence à mémoire bornée pour Pico-Chan
+#
+#   RateLimiter   : token bucket par clé (IP), une instance par route.
+#                   Entrées rangées par dernier accès (OrderedDict): la tête est la plus
+#                   ancienne -> purge en O(1) amorti à chaque appel, plafond dur max_keys.
+#                   Un bucket inactif depuis burst/rate s est plein: l'oublier ne change rien.
+#   ActiveCounter : nombre approximatif de clés distinctes vues sur une fenêtre glissante
+#                   (HyperLogLog par sous-fenêtre, union à la lecture). Mémoire fixe,
+#                   quel que soit le nombre d'IP.
+
+import math, time, hashlib
+from collections import OrderedDict, deque
+from typing import Deque, Optional, Tuple
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        # rate <= 0 -> illimité
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self.ttl = self.burst / rate if rate > 0 else 0.0
+        self._b: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()   # clé -> (jetons, ts)
+
+    def allow(self, key: str, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        if self.rate <= 0: return True
+        if now is None: now = time.monotonic()
+        b = self._b.pop(key, None)
+        tokens = self.burst if b is None else min(self.burst, b[0] + (now - b[1]) * self.rate)
+        ok = tokens >= cost
+        if ok: tokens -= cost
+        self._b[key] = (tokens, now)
+        self._sweep(now)
+        return ok
+
+    def _sweep(self, now: float):
+        d = self._b
+        while d:
+            key = next(iter(d))
+            if len(d) <= self.max_keys and now - d[key][1] < self.ttl: break
+            d.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._b)
+
+def parse_rate(raw: Optional[str], rate: float, burst: float) -> Tuple[float, float]:
+    # "rate,burst" (jetons/s, capacité), ex: "60,120"; "0" = illimité
+    if not raw: return rate, burst
+    parts = raw.split(",")
+    rate = float(parts[0])
+    burst = float(parts[1]) if len(parts) > 1 else max(rate, 1.0)
+    return rate, burst
+
+# --------------------------
+# Présence approximative
+# --------------------------
+def _hash64(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+def hll_add(reg: bytearray, p: int, h: int):
+    idx = h & ((1 << p) - 1)
+    w = h >> p
+    rank = (64 - p) - w.bit_length() + 1
+    if rank > reg[idx]: reg[idx] = rank
+
+def hll_estimate(reg, p: int) -> int:
+    m = 1 << p
+    alpha = 0.7213 / (1 + 1.079 / m)
+    est = alpha * m * m / sum(2.0 ** -r for r in reg)
+    zeros = reg.count(0)
+    if est <= 2.5 * m and zeros:
+        est = m * math.log(m / zeros)   # linear counting (petits effectifs)
+    return int(est + 0.5)
+
+class ActiveCounter:
+    def __init__(self, window_s: float, slots: int = 5, p: int = 11):
+        self.p = p
+        self.slot_s = window_s / slots
+        self.nslots = slots
+        self._slots: Deque[Tuple[int, bytearray]] = deque()   # (n° de sous-fenêtre, registres)
+        self._cache: Tuple[float, int] = (-1.0, 0)
+
+    def _slot(self, now: float) -> int:
+        return int(now // self.slot_s)
+
+    def _expire(self, cur: int):
+        while self._slots and self._slots[0][0] <= cur - self.nslots:
+            self._slots.popleft()
+
+    def add(self, key: str, now: Optional[float] = None):
+        if now is None: now = time.monotonic()
+        cur = self._slot(now)
+        if not self._slots or self._slots[-1][0] != cur:
+            self._expire(cur)
+            self._slots.append((cur, bytearray(1 << self.p)))
+        hll_add(self._slots[-1][1], self.p, _hash64(key))
+
+    def count(self, now: Optional[float] = None) -> int:
+        # union des sous-fenêtres encore actives; recalculée au plus une fois par seconde
+        if now is None: now = time.monotonic()
+        at, n = self._cache
+        if now - at < 1.0: return n
+        self._expire(self._slot(now))
+        if not self._slots:
+            n = 0
+        elif len(self._slots) == 1:
+            n = hll_estimate(self._slots[0][1], self.p)
+        else:
+            n = hll_estimate(bytes(map(max, *(reg for _, reg in self._slots))), self.p)
+        self._cache = (now, n)
+        return n
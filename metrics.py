@@ -0,0 +1,151 @@
+# metrics.py — métriques Prometheus (format texte) pour Pico-Chan
+#
+#   Counter / Gauge / Histogram : valeurs en mémoire du process, mises à jour sans verrou
+#                   (la boucle asyncio est mono-thread). Un observe() = une recherche de
+#                   série dans un dict + un bisect: assez peu pour rester actif en charge.
+#                   fn=... -> valeurs calculées seulement au scrape (gauges d'état).
+#   HttpMetrics   : middleware ASGI, latence par route (jusqu'aux en-têtes de réponse;
+#                   pour un flux SSE = ouverture du flux) et compteur par code HTTP.
+#   sample_loop_lag : tâche de fond, retard du réveil d'un sleep = blocage de la boucle.
+#
+# En multi-workers chaque process expose ses propres valeurs (label pid sur picochan_process_info).
+
+import time, asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_registry: List["_Metric"] = []
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, _esc(v)) for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v) -> str:
+    if isinstance(v, float):
+        if v == float("inf"): return "+Inf"
+        return repr(v)
+    return str(v)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 fn: Optional[Callable[[], Iterable[Tuple[Tuple, float]]]] = None):
+        self.name, self.help, self.labels, self.fn = name, help, tuple(labels), fn
+        self.values: Dict[Tuple, float] = {}
+        _registry.append(self)
+
+    def series(self) -> Iterable[Tuple[Tuple, float]]:
+        return self.fn() if self.fn is not None else self.values.items()
+
+    def render(self) -> List[str]:
+        return ["%s%s %s" % (self.name, _labels(self.labels, lv), _num(v)) for lv, v in self.series()]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *lv, n: float = 1):
+        self.values[lv] = self.values.get(lv, 0) + n
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, v: float, *lv):
+        self.values[lv] = v
+
+    def inc(self, *lv, n: float = 1):
+        self.values[lv] = self.values.get(lv, 0) + n
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, List] = {}   # labels -> [compte par bucket (+Inf en dernier), somme]
+
+    def observe(self, v: float, *lv):
+        s = self._series.get(lv)
+        if s is None:
+            s = self._series[lv] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, v)] += 1
+        s[1] += v
+
+    def render(self) -> List[str]:
+        out = []
+        for lv, (counts, total) in self._series.items():
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                out.append("%s_bucket%s %d" % (self.name, _labels(self.labels, lv, 'le="%s"' % _num(float(le))), acc))
+            out.append("%s_sum%s %s" % (self.name, _labels(self.labels, lv), _num(total)))
+            out.append("%s_count%s %d" % (self.name, _labels(self.labels, lv), acc))
+        return out
+
+def render() -> str:
+    out = []
+    for m in _registry:
+        out.append("# HELP %s %s" % (m.name, m.help))
+        out.append("# TYPE %s %s" % (m.name, m.kind))
+        out.extend(m.render())
+    return "\n".join(out) + "\n"
+
+# --------------------------
+# HTTP
+# --------------------------
+HTTP_SECONDS = Histogram("picochan_http_request_duration_seconds",
+                         "Latence jusqu'aux en-têtes de réponse (SSE: ouverture du flux)", ("route",))
+HTTP_TOTAL = Counter("picochan_http_requests_total", "Requêtes HTTP par route et code", ("route", "code"))
+
+class HttpMetrics:
+    # Middleware ASGI pur (pas de BaseHTTPMiddleware: il bufferise et coûte une tâche par requête).
+    # Le routeur complète le scope ("endpoint") -> label = chemin déclaré de la route,
+    # cardinalité bornée quelles que soient les URL demandées.
+    def __init__(self, app):
+        self.app = app
+        self._paths: Optional[Dict[int, str]] = None
+
+    def _route(self, scope) -> str:
+        if self._paths is None:
+            routes = getattr(scope.get("app"), "routes", None)
+            if routes is None: return "other"
+            self._paths = {id(getattr(r, "endpoint", None) or getattr(r, "app", None)): r.path for r in routes}
+        return self._paths.get(id(scope.get("endpoint")), "other")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        code = [500]
+
+        async def send_wrapped(message):
+            if message["type"] == "http.response.start":
+                code[0] = message["status"]
+                HTTP_SECONDS.observe(time.perf_counter() - t0, self._route(scope))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapped)
+        finally:
+            HTTP_TOTAL.inc(self._route(scope), code[0])
+
+# --------------------------
+# Boucle asyncio
+# --------------------------
+LOOP_LAG = Histogram("picochan_event_loop_lag_seconds", "Retard de réveil de la boucle asyncio",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+LOOP_LAG_LAST = Gauge("picochan_event_loop_lag_last_seconds", "Dernier retard mesuré de la boucle asyncio")
+
+async def sample_loop_lag(period: float = 0.5):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(period)
+        lag = max(0.0, time.perf_counter() - t0 - period)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_LAST.set(round(lag, 6))
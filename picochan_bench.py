@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# picochan_bench.py — banc de charge asyncio pour le fan-out SSE de Pico-Chan
+#
+# Ouvre N abonnés /stream (discussion) + K abonnés /dessin/stream, pendant que M posteurs
+# envoient /msg et D posteurs /dessin/diff. Mesure:
+#   - latence post -> réception (p50/p90/p99/max), par flux
+#   - messages reçus/s (somme sur les abonnés) et posts/s
+#   - mémoire par connexion (RSS du serveur: en process, ou --server-pid)
+#   - lag de la boucle asyncio (échantillonneur à 50 ms; en process = client + serveur)
+#
+# Usage:
+#   python picochan_bench.py                          # app lancée en process (port libre)
+#   python picochan_bench.py --url http://127.0.0.1:8080 --server-pid 1234
+#   python picochan_bench.py --subs 2000 --canvas-subs 500 --posters 4 --rate 5 --duration 20
+#   python picochan_bench.py --record requests.jsonl  # enregistre le trafic généré
+#   python picochan_bench.py --replay requests.jsonl  # rejoue la même trace (avant/après)
+#
+# Trace (une requête JSON par ligne):
+#   {"t": 0.123, "method": "POST", "path": "/msg", "ip": "10.0.0.1", "form": {"text": "b12"}}
+#   {"t": 0.130, "method": "POST", "path": "/dessin/diff", "ip": "10.0.1.1", "json": {"pixels": [...]}}
+#
+# Chaque posteur a sa propre IP (X-Forwarded-For) -> pas de 429 tant que le débit par posteur
+# reste sous les limites du serveur. En process, les limites sont levées (PICOCHAN_RATE_*=0).
+# Client HTTP/1.1 minimal sur asyncio: pas de dépendance en plus de requirements.txt.
+
+import os, sys, time, json, random, asyncio, argparse, resource
+from array import array
+from urllib.parse import urlencode, urlsplit
+from typing import Any, Dict, List, Optional, Tuple
+
+# --------------------------
+# Client HTTP minimal
+# --------------------------
+async def read_head(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str]]:
+    status_line = await reader.readline()
+    if not status_line: raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""): break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    return status, headers
+
+async def body_pieces(reader: asyncio.StreamReader, headers: Dict[str, str]):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return
+            data = await reader.readexactly(size + 2)
+            yield data[:-2]
+    elif "content-length" in headers:
+        n = int(headers["content-length"])
+        if n: yield await reader.readexactly(n)
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data: return
+            yield data
+
+class Conn:
+    # une connexion keep-alive (posteurs)
+    def __init__(self, host: str, port: int, ip: str):
+        self.host, self.port, self.ip = host, port, ip
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, form=None, body_json=None) -> int:
+        if self.writer is None or self.writer.is_closing():
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if form is not None:
+            body, ctype = urlencode(form).encode(), "application/x-www-form-urlencoded"
+        elif body_json is not None:
+            body, ctype = json.dumps(body_json).encode(), "application/json"
+        else:
+            body, ctype = b"", "text/plain"
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nX-Forwarded-For: {self.ip}\r\n"
+                f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n\r\n")
+        self.writer.write(head.encode() + body)
+        status, headers = await read_head(self.reader)
+        if status not in (204, 304):
+            async for _ in body_pieces(self.reader, headers): pass
+        if headers.get("connection", "").lower() == "close":
+            self.writer.close(); self.writer = None
+        return status
+
+# --------------------------
+# Mesures
+# --------------------------
+def pct(values, p: float) -> float:
+    if not values: return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(p / 100.0 * len(s)))]
+
+def fmt_ms(values) -> str:
+    if not values: return "n/a"
+    return "p50 %.1f  p90 %.1f  p99 %.1f  max %.1f ms" % tuple(
+        1000 * v for v in (pct(values, 50), pct(values, 90), pct(values, 99), max(values)))
+
+def rss_kb(pid: Optional[int] = None) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+class Bench:
+    def __init__(self, host: str, port: int, args):
+        self.host, self.port, self.args = host, port, args
+        self.sent_msg: Dict[int, float] = {}               # seq -> t envoi
+        self.sent_px: Dict[Tuple[int, str], float] = {}    # (index, ch) -> t envoi
+        self.lat_msg = array("d")
+        self.lat_px = array("d")
+        self.received = 0
+        self.posts = 0
+        self.errors: Dict[str, int] = {}
+        self.loop_lag = array("d")
+        self.connected = 0
+        self.seq = 0
+        self.t0 = 0.0
+        self.trace: List[Dict[str, Any]] = []
+        self.canvas_w, self.canvas_h = 24, 8
+
+    def err(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    # ---- abonnés
+    async def subscriber(self, path: str, ready: asyncio.Event, canvas: bool, ip: str):
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\nX-Forwarded-For: {ip}\r\n"
+                         f"Accept: text/event-stream\r\n\r\n".encode())
+            status, headers = await read_head(reader)
+            if status != 200:
+                self.err(f"sse {status}"); return
+        except (OSError, ConnectionError, ValueError):
+            self.err("sse connect"); return
+        self.connected += 1
+        if self.connected >= self.args.subs + self.args.canvas_subs: ready.set()
+        buf = b""
+        try:
+            async for piece in body_pieces(reader, headers):
+                buf += piece
+                while b"\n\n" in buf:
+                    ev, buf = buf.split(b"\n\n", 1)
+                    for line in ev.split(b"\n"):
+                        if line.startswith(b"data: "): self.on_data(line[6:], canvas)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            self.err("sse closed")
+        finally:
+            writer.close()
+
+    def on_data(self, raw: bytes, canvas: bool):
+        now = time.perf_counter()
+        self.received += 1
+        try:
+            m = json.loads(raw)
+        except ValueError:
+            return
+        if canvas:
+            if "full" in m:
+                self.canvas_w, self.canvas_h = m["full"]["w"], m["full"]["h"]
+            elif "px" in m:
+                for i, ch in zip(m["px"], m["ch"]):
+                    t = self.sent_px.get((i, ch))
+                    if t is not None: self.lat_px.append(now - t)
+        else:
+            text = m.get("text") or ""
+            if text.startswith("b"):
+                t = self.sent_msg.get(int(text[1:]) if text[1:].isdigit() else -1)
+                if t is not None: self.lat_msg.append(now - t)
+
+    # ---- posteurs
+    async def send(self, conn: Conn, op: Dict[str, Any]):
+        now = time.perf_counter()
+        if op["path"] == "/msg":
+            text = op["form"]["text"]
+            if text[1:].isdigit(): self.sent_msg[int(text[1:])] = now
+        else:
+            for p in op["json"]["pixels"]:
+                self.sent_px[(p["y"] * self.canvas_w + p["x"], p["ch"])] = now
+        if self.args.record:
+            self.trace.append({"t": round(now - self.t0, 4), **op})
+        try:
+            status = await conn.request(op["method"], op["path"], op.get("form"), op.get("json"))
+            self.posts += 1
+            if status >= 400: self.err(f"{op['path']} {status}")
+        except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError):
+            self.err(f"{op['path']} conn")
+
+    async def poster(self, n: int, stop_at: float):
+        conn = Conn(self.host, self.port, f"10.0.0.{n + 1}")
+        period = 1.0 / self.args.rate
+        while time.perf_counter() < stop_at:
+            self.seq += 1
+            await self.send(conn, {"method": "POST", "path": "/msg", "ip": conn.ip,
+                                   "form": {"text": f"b{self.seq}"}})
+            await asyncio.sleep(period * random.uniform(0.5, 1.5))
+
+    async def diff_poster(self, n: int, stop_at: float):
+        conn = Conn(self.host, self.port, f"10.0.1.{n + 1}")
+        period = 1.0 / self.args.diff_rate
+        chars = "#*+o.-"
+        while time.perf_counter() < stop_at:
+            w, h = self.canvas_w, self.canvas_h
+            pixels = [{"x": random.randrange(w), "y": random.randrange(h), "ch": random.choice(chars)}
+                      for _ in range(self.args.diff_pixels)]
+            await self.send(conn, {"method": "POST", "path": "/dessin/diff", "ip": conn.ip,
+                                   "json": {"pixels": pixels}})
+            await asyncio.sleep(period * random.uniform(0.5, 1.5))
+
+    async def replayer(self, ops: List[Dict[str, Any]]):
+        conns: Dict[str, Conn] = {}
+        start = time.perf_counter()
+        async def one(op):
+            conn = conns.get(op["ip"])
+            if conn is None: conn = conns[op["ip"]] = Conn(self.host, self.port, op["ip"])
+            await self.send(conn, {k: v for k, v in op.items() if k != "t"})
+        # une connexion par IP, ops d'une même IP dans l'ordre
+        by_ip: Dict[str, List[Dict[str, Any]]] = {}
+        for op in ops: by_ip.setdefault(op["ip"], []).append(op)
+        async def run_ip(items):
+            for op in items:
+                delay = start + op["t"] - time.perf_counter()
+                if delay > 0: await asyncio.sleep(delay)
+                await one(op)
+        await asyncio.gather(*(run_ip(items) for items in by_ip.values()))
+
+    async def lag_sampler(self):
+        interval = 0.05
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0.0, time.perf_counter() - t - interval))
+
+    # ---- scénario
+    async def run(self, server_pid: Optional[int]) -> Dict[str, Any]:
+        a = self.args
+        lag = asyncio.create_task(self.lag_sampler())
+        rss0 = rss_kb(server_pid)
+        ready = asyncio.Event()
+        if a.subs + a.canvas_subs == 0: ready.set()
+        # une IP par abonné (limite d'abonnements par IP côté serveur)
+        ip = lambda n: f"10.2.{n // 250}.{n % 250 + 1}"
+        subs = [asyncio.create_task(self.subscriber("/stream?chan=discussion", ready, False, ip(n)))
+                for n in range(a.subs)]
+        subs += [asyncio.create_task(self.subscriber("/dessin/stream", ready, True, ip(a.subs + n)))
+                 for n in range(a.canvas_subs)]
+        try:
+            await asyncio.wait_for(ready.wait(), a.connect_timeout)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0.5)
+        rss1 = rss_kb(server_pid)
+        self.received = 0
+        self.t0 = time.perf_counter()
+        if a.replay:
+            with open(a.replay) as f:
+                ops = [json.loads(line) for line in f if line.strip()]
+            await self.replayer(ops)
+        else:
+            stop_at = self.t0 + a.duration
+            await asyncio.gather(*[self.poster(i, stop_at) for i in range(a.posters)],
+                                 *[self.diff_poster(i, stop_at) for i in range(a.diff_posters)])
+        await asyncio.sleep(a.drain)
+        elapsed = time.perf_counter() - self.t0
+        for t in subs: t.cancel()
+        lag.cancel()
+        await asyncio.gather(*subs, lag, return_exceptions=True)
+        if a.record:
+            with open(a.record, "w") as f:
+                for op in self.trace: f.write(json.dumps(op, ensure_ascii=False) + "\n")
+        conns = max(self.connected, 1)
+        return {
+            "connected": self.connected, "elapsed_s": round(elapsed, 2),
+            "posts": self.posts, "posts_per_s": round(self.posts / elapsed, 1),
+            "received": self.received, "received_per_s": round(self.received / elapsed, 1),
+            "lat_msg": list(self.lat_msg), "lat_px": list(self.lat_px),
+            "loop_lag": list(self.loop_lag),
+            "mem_per_conn_kb": round((rss1 - rss0) / conns, 1) if rss0 and rss1 else None,
+            "errors": self.errors,
+        }
+
+def report(r: Dict[str, Any], inproc: bool):
+    print(f"connexions SSE     : {r['connected']}")
+    print(f"durée              : {r['elapsed_s']} s")
+    print(f"posts              : {r['posts']} ({r['posts_per_s']}/s)")
+    print(f"frames reçues      : {r['received']} ({r['received_per_s']}/s)")
+    print(f"latence /stream    : {fmt_ms(r['lat_msg'])}  ({len(r['lat_msg'])} mesures)")
+    print(f"latence canvas     : {fmt_ms(r['lat_px'])}  ({len(r['lat_px'])} mesures)")
+    print(f"lag boucle asyncio : {fmt_ms(r['loop_lag'])}" + ("  (client + serveur)" if inproc else ""))
+    if r["mem_per_conn_kb"] is not None:
+        print(f"mémoire/connexion  : {r['mem_per_conn_kb']} KiB" + ("  (client + serveur)" if inproc else ""))
+    if r["errors"]:
+        print(f"erreurs            : {r['errors']}")
+
+def raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError): pass
+
+async def main(args) -> Dict[str, Any]:
+    raise_nofile()
+    server = None
+    if args.url:
+        u = urlsplit(args.url)
+        host, port = u.hostname or "127.0.0.1", u.port or 80
+    else:
+        # app en process: limites levées pour ne mesurer que le fan-out
+        for route in ("MSG", "PUBLISH", "DIFF", "SUB"):
+            os.environ.setdefault(f"PICOCHAN_RATE_{route}", "0")
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        import uvicorn
+        from app import app
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning",
+                                               backlog=4096))
+        serve = asyncio.create_task(server.serve())
+        while not server.started: await asyncio.sleep(0.05)
+        host, port = server.servers[0].sockets[0].getsockname()[:2]
+    bench = Bench(host, port, args)
+    try:
+        r = await bench.run(args.server_pid if args.url else os.getpid())
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await serve
+    return r
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Banc de charge SSE Pico-Chan")
+    ap.add_argument("--url", help="serveur cible (sinon app lancée en process)")
+    ap.add_argument("--server-pid", type=int, help="PID du serveur pour la mémoire/connexion (--url)")
+    ap.add_argument("--subs", type=int, default=200, help="abonnés /stream?chan=discussion")
+    ap.add_argument("--canvas-subs", type=int, default=50, help="abonnés /dessin/stream")
+    ap.add_argument("--posters", type=int, default=2, help="posteurs /msg")
+    ap.add_argument("--rate", type=float, default=5.0, help="posts/s par posteur /msg")
+    ap.add_argument("--diff-posters", type=int, default=2, help="posteurs /dessin/diff")
+    ap.add_argument("--diff-rate", type=float, default=20.0, help="diffs/s par posteur")
+    ap.add_argument("--diff-pixels", type=int, default=4, help="pixels par diff")
+    ap.add_argument("--duration", type=float, default=10.0, help="durée de la charge (s)")
+    ap.add_argument("--drain", type=float, default=1.0, help="attente finale des derniers messages (s)")
+    ap.add_argument("--connect-timeout", type=float, default=30.0)
+    ap.add_argument("--record", help="écrit la trace des requêtes envoyées (JSONL)")
+    ap.add_argument("--replay", help="rejoue une trace JSONL au lieu des posteurs synthétiques")
+    ap.add_argument("--json", action="store_true", help="résumé JSON (comparaison avant/après)")
+    args = ap.parse_args()
+    if args.replay and args.record and os.path.abspath(args.replay) == os.path.abspath(args.record):
+        ap.error("--record et --replay sur le même fichier")
+    r = asyncio.run(main(args))
+    if args.json:
+        summary = {k: v for k, v in r.items() if not isinstance(v, list)}
+        for k in ("lat_msg", "lat_px", "loop_lag"):
+            summary[k + "_ms"] = {f"p{p}": round(1000 * pct(r[k], p), 2) for p in (50, 90, 99)}
+        print(json.dumps(summary))
+    else:
+        report(r, not args.url)
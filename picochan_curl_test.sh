@@ -66,4 +66,33 @@ echo "$headers2" | head -1 | grep -q "200" \
   || echo "⚠️  /dessin/stream: pas de 200 visible (peut être lié au timing, sans gravité)"
 set -e
 
+# 10) Reprise SSE: Last-Event-ID = id du message 3) -> seul le suivant est rejoué
+# (sleep: limite de /msg, 1 post/s par défaut)
+ID1=$(curl -fsS "$BASE/poll?last_id=0&chan=discussion" | grep -o "\"id\":[0-9]*[^}]*$MSG" | grep -o '^"id":[0-9]*' | cut -d: -f2)
+[ -n "$ID1" ] || fail "no id for the posted message"
+sleep 1.1
+MSG2="curl-test-2-$(date +%s%N)"
+curl -fsS -o /dev/null -X POST -F "chan=discussion" -F "text=$MSG2" "$BASE/msg"
+replay=$(curl -sN --max-time 1 -H "Last-Event-ID: $ID1" "$BASE/stream?chan=discussion" || true)
+echo "$replay" | grep -q "$MSG2" || fail "Last-Event-ID replay missing the next message"
+echo "$replay" | grep -q "$MSG"  && fail "Last-Event-ID replay resent the acknowledged message"
+pass "/stream replays after Last-Event-ID"
+
+# 11) Salons: un message posté dans ?room= n'apparaît que dans ce salon
+sleep 1.1
+ROOM="curl-$(date +%s)"
+MSG3="curl-test-room-$(date +%s%N)"
+curl -fsS -o /dev/null -X POST -F "room=$ROOM" -F "chan=discussion" -F "text=$MSG3" "$BASE/msg"
+curl -fsS "$BASE/poll?room=$ROOM&chan=discussion" | grep -q "$MSG3" || fail "/poll?room= missing the message"
+curl -fsS "$BASE/poll?chan=discussion" | grep -q "$MSG3" && fail "room message leaked into the default room"
+code=$(curl -s -o /dev/null -w "%{http_code}" "$BASE/poll?room=Bad%20Room")
+[ "$code" = "400" ] || fail "invalid room name returned $code"
+pass "?room= isolates messages, invalid names rejected"
+
+# 12) /metrics (format texte Prometheus)
+metrics="$(curl -fsS "$BASE/metrics")"
+echo "$metrics" | grep -q '^# TYPE picochan_http_requests_total counter' || fail "/metrics missing http counter"
+echo "$metrics" | grep -q '^picochan_rooms ' || fail "/metrics missing picochan_rooms"
+pass "/metrics ok"
+
 echo "🎉 Tests terminés avec succès."
@@ -0,0 +1,46 @@
+# rooms.py — salons de Pico-Chan: noms, budgets mémoire, réglages partagés app/broker/hub
+#
+# Un salon = un tableau indépendant: historique par channel (discussion, dessin) + canvas optionnel.
+# Créé au premier usage (?room=nom), évincé quand plus personne ne l'écoute depuis
+# PICOCHAN_ROOM_IDLE_S (le journal disque, s'il est activé, le rechargera au prochain accès;
+# il est lui-même supprimé après PICOCHAN_ROOM_TTL_S sans écriture).
+# Le salon par défaut garde les réglages historiques (PICOCHAN_MAX_MSGS*, journal canvas long)
+# et n'est jamais évincé; les autres ont un budget plus serré.
+
+import os, re
+from typing import Optional, Tuple
+
+ROOM_DEFAULT = "main"
+ROOM_RE = re.compile(r"[a-z0-9_-]{1,32}")   # sert aussi de nom de dossier dans PICOCHAN_DATA_DIR
+
+MAX_ROOMS = int(os.getenv("PICOCHAN_MAX_ROOMS", "1000"))       # salons résidents (LRU au-delà)
+ROOM_IDLE_S = float(os.getenv("PICOCHAN_ROOM_IDLE_S", "300"))
+ROOM_MSGS = int(os.getenv("PICOCHAN_ROOM_MSGS", "128"))         # messages retenus par channel
+ROOM_JOURNAL = int(os.getenv("PICOCHAN_ROOM_JOURNAL", "64"))    # ticks canvas gardés pour la reprise
+ROOM_CANVAS = os.getenv("PICOCHAN_ROOM_CANVAS", "1") not in ("0","false","False","FALSE")
+# dossiers DATA_DIR/rooms/<nom>: supprimés après ROOM_TTL_S sans écriture, les plus anciens
+# au-delà de MAX_ROOM_DIRS (0 = pas de limite); le salon par défaut n'est jamais touché
+ROOM_TTL_S = float(os.getenv("PICOCHAN_ROOM_TTL_S", str(7 * 86400)))
+MAX_ROOM_DIRS = int(os.getenv("PICOCHAN_MAX_ROOM_DIRS", "10000"))
+
+def valid_room(name) -> bool:
+    return isinstance(name, str) and ROOM_RE.fullmatch(name) is not None
+
+def max_msgs_for(chan: Optional[str]) -> int:
+    # rétention par channel: PICOCHAN_MAX_MSGS_<CHAN>, sinon PICOCHAN_MAX_MSGS
+    default = int(os.getenv("PICOCHAN_MAX_MSGS", "512"))
+    if not chan: return default
+    return int(os.getenv("PICOCHAN_MAX_MSGS_" + chan.upper(), str(default)))
+
+def canvas_size() -> Tuple[int, int]:
+    return (int(os.getenv("PICOCHAN_CANVAS_W", "24")), int(os.getenv("PICOCHAN_CANVAS_H", "8")))
+
+def retention(room: str, chan: Optional[str]) -> int:
+    if room == ROOM_DEFAULT: return max_msgs_for(chan)
+    return min(ROOM_MSGS, max_msgs_for(chan))
+
+def has_canvas(room: str) -> bool:
+    return room == ROOM_DEFAULT or ROOM_CANVAS
+
+def canvas_journal(room: str) -> int:
+    return 1024 if room == ROOM_DEFAULT else ROOM_JOURNAL
@@ -26,8 +26,19 @@
   let seen        = new Set();   // de-dup ids
   let es          = null;        // SSE messages
   let esDessin    = null;        // SSE canvas
+  let canvasV     = -1;          // version du canvas reçue (reprise après coupure)
 
-  // Canvas (24x8)
+  // Salon: /?room=nom (défaut "main"), passé à chaque requête; clés /ws = "<salon>/<chan>"
+  const ROOM = (new URLSearchParams(location.search).get('room') || 'main').toLowerCase();
+  const RQ   = 'room=' + encodeURIComponent(ROOM);
+
+  // Transport: /ws multiplexé si le serveur l'active, SSE + POST sinon (ou si /ws ne s'ouvre pas)
+  const CANVAS_KEY = ROOM + '/canvas';
+  let transport   = (document.body.dataset.ws === '1' && 'WebSocket' in window) ? 'ws' : 'sse';
+  let ws          = null;
+  let wsOk        = false;       // /ws a déjà fonctionné -> on s'y reconnecte au lieu de repasser en SSE
+
+  // Canvas (24x8 par défaut, taille réelle reçue avec le premier snapshot)
   let G = { w:24, h:8, lines:Array(8).fill(' '.repeat(24)) };
 
   // Tools
@@ -100,16 +111,20 @@
     if (paneDiscussion) paneDiscussion.classList.toggle('on', chan === 'discussion');
     if (paneDessin)     paneDessin.classList.toggle('on', chan === 'dessin');
 
+    wsSend({op:'unsub', room:ROOM, chan:currentChan});
     currentChan = chan;
     last_id = 0;
     seen = new Set();
     if (log) log.innerHTML = '';
 
     if (es) { try{ es.close(); }catch(_){ } es = null; }
-    initialPoll().then(connectSSE);
+    subscribeFeed();
 
-    if (chan === 'dessin') { connectDessinSSE(); setTimeout(fitGridAuto, 50); }
-    else if (esDessin) { try{ esDessin.close(); }catch(_){ } esDessin = null; }
+    if (chan === 'dessin') { subscribeCanvas(); setTimeout(fitGridAuto, 50); }
+    else {
+      wsSend({op:'unsub', room:ROOM, chan:'canvas'});
+      if (esDessin) { try{ esDessin.close(); }catch(_){ } esDessin = null; }
+    }
   }
   tabBtns.forEach(b => b.addEventListener('click', () => setChan(b.dataset.chan)));
 
@@ -144,22 +159,89 @@
     }
   }
 
-  // ===== Feed networking (poll + SSE) =====
-  async function initialPoll(){
-    try{
-      const r = await fetch('/poll?last_id='+last_id+'&chan='+encodeURIComponent(currentChan), {cache:'no-store'});
-      if (!r.ok) return;
-      const arr = await r.json();
-      for (const m of arr){ addMsg(m); }
-    }catch(_){}
-  }
+  // ===== Feed networking (SSE + reprise) =====
+  // L'historique arrive par le flux (last_id=0), puis le live sans trou.
+  // Les reconnexions natives d'EventSource renvoient Last-Event-ID -> le serveur rejoue le manquant.
   function connectSSE(){
-    es = new EventSource('/stream?chan='+encodeURIComponent(currentChan));
-    es.onmessage = (ev)=>{ try { addMsg(JSON.parse(ev.data)); } catch(_){ } };
-    es.onerror   = ()=>{ setTimeout(()=>{ try{es.close();}catch(_){ } connectSSE(); }, 1200); };
+    const src = new EventSource('/stream?'+RQ+'&chan='+encodeURIComponent(currentChan)+'&last_id='+last_id);
+    es = src;
+    src.onmessage = (ev)=>{ try { addMsg(JSON.parse(ev.data)); } catch(_){ } };
+    src.onerror   = ()=>{
+      // CLOSED = le navigateur abandonne (ex: 5xx) -> on relance nous-mêmes depuis last_id
+      if (src.readyState !== EventSource.CLOSED || es !== src) return;
+      setTimeout(()=>{ if (es === src) connectSSE(); }, 1200);
+    };
+  }
+
+  // ===== WebSocket multiplexé =====
+  // Serveur -> client: "<salon>/<chan>\n" + les mêmes frames que SSE (id:/data:); clé "!" = erreur d'une opération.
+  // Client -> serveur: {op:'sub'|'unsub'|'px'|'msg'|'publish', ...}. Rien d'ouvert -> repli HTTP.
+  const utf8 = ('TextDecoder' in window) ? new TextDecoder() : null;
+
+  function wsSend(o){
+    if (!ws || ws.readyState !== 1) return false;
+    ws.send(JSON.stringify(o));
+    return true;
+  }
+
+  function subscribeFeed(){
+    if (transport === 'ws') wsSend({op:'sub', room:ROOM, chan:currentChan, since:last_id});
+    else connectSSE();
+  }
+
+  function subscribeCanvas(){
+    if (transport === 'ws') wsSend({op:'sub', room:ROOM, chan:'canvas', since:canvasV});
+    else connectDessinSSE();
+  }
+
+  function eachFrame(text, fn){
+    for (const block of text.split('\n\n')){
+      let id = '', data = null, event = '';
+      for (const line of block.split('\n')){
+        if (line.startsWith('data: ')) data = line.slice(6);
+        else if (line.startsWith('id: ')) id = line.slice(4);
+        else if (line.startsWith('event: ')) event = line.slice(7);
+      }
+      if (data !== null && !event) fn(data, id);
+    }
   }
 
-  // ====================== DESSIN 24×8 ======================
+  function onWsError(e){
+    if (navigator.vibrate && (e.status === 429 || e.op === 'publish')) navigator.vibrate(e.status === 429 ? 60 : 80);
+  }
+
+  function connectWS(){
+    const src = new WebSocket((location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '/ws');
+    src.binaryType = 'arraybuffer';
+    ws = src;
+    src.onopen = ()=>{
+      wsOk = true;
+      subscribeFeed();
+      if (currentChan === 'dessin') subscribeCanvas();
+    };
+    src.onmessage = (ev)=>{
+      const text = (typeof ev.data === 'string') ? ev.data : utf8.decode(ev.data);
+      const nl = text.indexOf('\n');
+      const key = text.slice(0, nl);
+      eachFrame(text.slice(nl + 1), (data, id)=>{
+        try{
+          if (key === CANVAS_KEY) onCanvasData(data, id);
+          else if (key === '!') onWsError(JSON.parse(data));
+          else addMsg(JSON.parse(data));
+        }catch(_){}
+      });
+    };
+    src.onclose = ()=>{
+      if (ws !== src) return;
+      ws = null;
+      if (wsOk) { setTimeout(connectWS, 1200); return; }   // coupure: reprise depuis last_id / canvasV
+      transport = 'sse';                                    // /ws indisponible -> SSE
+      subscribeFeed();
+      if (currentChan === 'dessin') subscribeCanvas();
+    };
+  }
+
+  // ====================== DESSIN ======================
   const PALETTE = ["█","▓","▒","░","#","*",".","o","+","-","|","/","\\","_"];
   function renderPalette(){
     if (!paletteEl) return;
@@ -180,6 +262,7 @@
   function buildGrid(){
     if (!gridEl) return;
     gridEl.innerHTML = '';
+    gridEl.style.gridTemplateColumns = 'repeat('+G.w+', var(--cell))';
     for(let y=0;y<G.h;y++){
       for(let x=0;x<G.w;x++){
         const d = document.createElement('div');
@@ -202,7 +285,7 @@
 
   async function sendDiff(pixels){
     try{
-      await fetch('/dessin/diff', {
+      await fetch('/dessin/diff?'+RQ, {
         method:'POST',
         headers:{'Content-Type':'application/json'},
         body: JSON.stringify({ pixels })
@@ -210,6 +293,25 @@
     }catch(_){}
   }
 
+  // Pixels groupés: la dernière valeur de chaque cellule, envoyée en un lot par tick serveur (~25 Hz)
+  // {op:'px', i:[y*w+x,...], ch:'...'} sur /ws, sinon POST /dessin/diff (256 pixels max par lot)
+  const pendingPx = new Map();   // i -> ch
+  let pxTimer = null;
+  function queuePixel(x,y,ch){
+    pendingPx.set(y*G.w + x, ch);
+    if (!pxTimer) pxTimer = setTimeout(flushPixels, 40);
+  }
+  function flushPixels(){
+    if (pxTimer) { clearTimeout(pxTimer); pxTimer = null; }
+    const idx = Array.from(pendingPx.keys()), chars = Array.from(pendingPx.values());
+    pendingPx.clear();
+    for (let k=0;k<idx.length;k+=256){
+      const i = idx.slice(k, k+256), ch = chars.slice(k, k+256);
+      if (!wsSend({op:'px', room:ROOM, i, ch:ch.join('')}))
+        sendDiff(i.map((p,n)=>({x:p % G.w, y:(p / G.w)|0, ch:ch[n]})));
+    }
+  }
+
   // Pointer events (mouse/touch/stylus)
   gridEl?.addEventListener('pointerdown', (e)=>{
     const t = e.target.closest('.cell'); if (!t) return;
@@ -221,7 +323,7 @@
     const ch = brushChar();
     if (G.lines[y][x] !== ch){
       updateCell(x,y,ch);
-      sendDiff([{x,y,ch}]);
+      queuePixel(x,y,ch);
     }
   });
   gridEl?.addEventListener('pointermove', (e)=>{
@@ -234,7 +336,7 @@
     const ch = brushChar();
     if (G.lines[y][x] !== ch){
       updateCell(x,y,ch);
-      sendDiff([{x,y,ch}]);
+      queuePixel(x,y,ch);
     }
   });
   function endPaint(e){
@@ -256,7 +358,7 @@
     const ch = ' ';
     if (G.lines[y][x] !== ch){
       updateCell(x,y,ch);
-      sendDiff([{x,y,ch}]);
+      queuePixel(x,y,ch);
     }
   });
 
@@ -264,11 +366,10 @@
   eraserBtn?.addEventListener('click', ()=> setEraser(!eraserOn));
   clearBtn?.addEventListener('click', async ()=>{
     if (!confirm('Effacer tout le canvas ?')) return;
-    const pixels = [];
     for (let y=0;y<G.h;y++){
       for (let x=0;x<G.w;x++){
         if (G.lines[y][x] !== ' '){
-          pixels.push({x,y,ch:' '});
+          queuePixel(x,y,' ');
           G.lines[y] = G.lines[y].substring(0,x) + ' ' + G.lines[y].substring(x+1);
         }
       }
@@ -277,11 +378,13 @@
     for (let i=0;i<(gridEl?.children.length||0);i++){
       gridEl.children[i].textContent = ' ';
     }
-    await sendDiff(pixels);
+    flushPixels();
   });
   publishBtn?.addEventListener('click', async ()=>{
+    flushPixels();
+    if (wsSend({op:'publish', room:ROOM})) return;
     try{
-      const r = await fetch('/dessin/publish', { method:'POST' });
+      const r = await fetch('/dessin/publish?'+RQ, { method:'POST' });
       if (!r.ok && navigator.vibrate) navigator.vibrate(80);
     }catch(_){}
   });
@@ -311,22 +414,33 @@
     ro.observe(paneDessin);
   }
 
+  // Frames canvas (SSE ou /ws)
+  function onCanvasData(data, id){
+    if (id) canvasV = +id;
+    const m = JSON.parse(data);
+    if (m.full){
+      G.w = m.full.w; G.h = m.full.h; G.lines = m.full.lines;
+      buildGrid();
+    } else if (m.px){
+      // un tick = toutes les cellules changées: indices y*w+x + un caractère par indice
+      const chars = Array.from(m.ch);
+      for (let k=0;k<m.px.length;k++){
+        const i = m.px[k];
+        updateCell(i % G.w, (i / G.w) | 0, chars[k]);
+      }
+    }
+  }
+
   // SSE canvas
   function connectDessinSSE(){
     if (esDessin) { try{ esDessin.close(); }catch(_){ } }
-    esDessin = new EventSource('/dessin/stream');
-    esDessin.onmessage = (ev)=>{
-      try{
-        const m = JSON.parse(ev.data);
-        if (m.full){
-          G.w = m.full.w; G.h = m.full.h; G.lines = m.full.lines;
-          buildGrid();
-        } else if (typeof m.x === 'number'){
-          updateCell(m.x, m.y, m.ch);
-        }
-      }catch(_){}
+    const src = new EventSource('/dessin/stream?' + RQ + (canvasV >= 0 ? '&v='+canvasV : ''));
+    esDessin = src;
+    src.onmessage = (ev)=>{ try{ onCanvasData(ev.data, ev.lastEventId); }catch(_){} };
+    src.onerror = ()=>{
+      if (src.readyState !== EventSource.CLOSED || esDessin !== src) return;
+      setTimeout(()=>{ if (esDessin === src) connectDessinSSE(); }, 1200);
     };
-    esDessin.onerror = ()=>{ setTimeout(connectDessinSSE, 1200); };
   }
 
   // Discussion submit
@@ -334,8 +448,10 @@
     ev.preventDefault();
     const text = (inputText?.value || '').trim();
     if (!text) return;
+    if (wsSend({op:'msg', room:ROOM, text})) { if (inputText) inputText.value = ''; inputText?.focus(); return; }
     try{
       const fd = new FormData();
+      fd.set('room', ROOM);
       fd.set('chan','discussion');
       fd.set('text', text);
       const r = await fetch('/msg', { method:'POST', body: fd });
@@ -346,6 +462,14 @@
   });
 
   // Feed boot
+  if (ROOM !== 'main'){
+    const h1 = document.querySelector('h1');
+    if (h1) h1.textContent += ' · ' + ROOM;
+    document.title += ' · ' + ROOM;
+    // salons sans canvas (PICOCHAN_ROOM_CANVAS=0): pas d'onglet dessin
+    if (document.body.dataset.roomCanvas === '0')
+      tabBtns.forEach(b => { if (b.dataset.chan === 'dessin') b.hidden = true; });
+  }
   renderPalette();
-  initialPoll().then(connectSSE);
+  if (transport === 'ws') connectWS(); else connectSSE();
 })();
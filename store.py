@@ -0,0 +1,366 @@
+# store.py — persistance optionnelle de Pico-Chan (journal append-only + snapshots canvas)
+#
+# Activée par PICOCHAN_DATA_DIR. Utilisée par le détenteur de l'état:
+# LocalBroker (mono-process) ou le Hub (multi-workers), jamais par les miroirs.
+#
+# Un Store par salon (dossier DATA_DIR pour le salon par défaut, DATA_DIR/rooms/<nom> sinon),
+# ouvert au chargement du salon et fermé à son éviction; Stores les regroupe et supprime
+# les dossiers de salons fermés restés sans écriture (TTL) ou en surnombre (les plus anciens).
+# Fichiers d'un salon (créés à la première écriture):
+#   msgs-NNNNNNNN.log    messages, un enregistrement par message (nouveau segment écrit via tmp + rename)
+#   canvas-NNNNNNNN.jnl  lots de pixels {"v", "c":[[x, y, ch], ...]} depuis le dernier snapshot
+#   canvas.snap          snapshot JSON {"v", "w", "h", "lines"} (écrit via tmp + rename)
+# Enregistrement: <u32 longueur><u32 crc32><JSON utf-8>. Une fin tronquée (crash pendant
+# l'écriture) est détectée par longueur/crc et coupée à la reprise.
+#
+# Le chemin des requêtes ne touche jamais au disque: append_*() empile en mémoire,
+# une seule tâche de fond (Stores) écrit + fsync les lots de tous les salons ouverts toutes
+# les PICOCHAN_FSYNC_MS (group commit) dans un thread. Un crash peut donc perdre au plus
+# la dernière fenêtre non fsyncée.
+#
+# Rotation/compaction: après seg_max nouveaux messages (MAX_MSGS) dans le segment courant,
+# le suivant commence par les messages encore retenus, puis les anciens segments sont
+# supprimés. Le dernier segment suffit toujours à la reprise -> temps de boot constant
+# quelle que soit l'ancienneté du journal. Même principe pour le canvas: chaque snapshot
+# ouvre un nouveau segment de journal et supprime les précédents.
+
+import os, time, mmap, zlib, shutil, struct, asyncio
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import codec
+
+HDR = struct.Struct("<II")
+
+def _record(o) -> bytes:
+    payload = codec.dumps(o)
+    return HDR.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(path: str) -> Tuple[List[Any], int]:
+    # (objets lus, offset du dernier enregistrement valide)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0: return [], 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            out, off = [], 0
+            while off + HDR.size <= size:
+                n, crc = HDR.unpack_from(mm, off)
+                end = off + HDR.size + n
+                if end > size: break
+                payload = mm[off + HDR.size:end]
+                if zlib.crc32(payload) != crc: break
+                try:
+                    out.append(codec.loads(payload))
+                except ValueError:
+                    break
+                off = end
+            return out, off
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try: os.fsync(fd)
+    finally: os.close(fd)
+
+class Store:
+    # canvas_w = canvas_h = 0 -> salon sans canvas (pas de journal ni de snapshot)
+    def __init__(self, path: str, canvas_w: int, canvas_h: int, seg_max: int, retention=None):
+        self.path = path
+        self.w, self.h = canvas_w, canvas_h
+        self.seg_max = max(1, seg_max)
+        self.retention = retention or (lambda chan: seg_max)   # chan -> nb de messages retenus
+        # état nécessaire aux compactions (références partagées, pas de copie des messages)
+        self.msgs: Dict[str, Deque[Dict[str, Any]]] = {}
+        self.canvas = [[" "] * canvas_w for _ in range(canvas_h)]
+        self.v = 0
+        self.snap_v = 0
+        self.msg_seq = self.jnl_seq = 0
+        self.msg_count = 0          # enregistrements dans le segment courant
+        self.msg_limit = seg_max    # seuil de rotation = base compactée + seg_max
+        self._ops: List[Tuple] = []
+        self._msg_f = self._jnl_f = None
+
+    # ---- fichiers
+    def _seqs(self, prefix: str, ext: str) -> List[int]:
+        out = []
+        if not os.path.isdir(self.path): return out
+        for name in os.listdir(self.path):
+            if name.startswith(prefix + "-") and name.endswith(ext):
+                try: out.append(int(name[len(prefix) + 1:-len(ext)]))
+                except ValueError: pass
+        return sorted(out)
+
+    def _msg_path(self, seq: int) -> str:
+        return os.path.join(self.path, "msgs-%08d.log" % seq)
+
+    def _jnl_path(self, seq: int) -> str:
+        return os.path.join(self.path, "canvas-%08d.jnl" % seq)
+
+    def _snap_path(self) -> str:
+        return os.path.join(self.path, "canvas.snap")
+
+    def _open_tail(self, path: str, good: int):
+        f = open(path, "ab")
+        if f.tell() != good:
+            f.truncate(good)   # fin tronquée par un crash
+        return f
+
+    def _ensure_files(self):
+        # salon jamais écrit: dossier et segments créés au premier lot
+        if self._msg_f is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._msg_f = open(self._msg_path(self.msg_seq), "ab")
+        if self._jnl_f is None and self.w and self.h:
+            self._jnl_f = open(self._jnl_path(self.jnl_seq), "ab")
+
+    # ---- reprise
+    def recover(self) -> Dict[str, Any]:
+        # {"next_id", "msgs":[...] (ordre des ids), "lines", "v"}
+        msgs: List[Dict[str, Any]] = []
+        seqs = self._seqs("msgs", ".log")
+        self.msg_seq = seqs[-1] if seqs else 1
+        path = self._msg_path(self.msg_seq)
+        if os.path.exists(path):
+            msgs, good = read_records(path)
+            self._msg_f = self._open_tail(path, good)
+        for m in msgs:
+            self._retain(m)
+        self.msg_count = len(msgs)
+        self.msg_limit = self._retained_count() + self.seg_max
+
+        next_id = (msgs[-1]["id"] + 1) if msgs else 1
+        retained = sorted((m for d in self.msgs.values() for m in d), key=lambda m: m["id"])
+        if not (self.w and self.h):
+            return {"next_id": next_id, "msgs": retained, "lines": None, "v": 0}
+
+        snap = None
+        if os.path.exists(self._snap_path()):
+            try:
+                with open(self._snap_path(), "rb") as f:
+                    snap = codec.loads(f.read())
+            except (OSError, ValueError):
+                snap = None
+        if snap:
+            for y, line in enumerate(snap.get("lines", [])[:self.h]):
+                for x, ch in enumerate(line[:self.w]):
+                    self.canvas[y][x] = ch
+            self.v = self.snap_v = int(snap.get("v", 0))
+        jseqs = self._seqs("canvas", ".jnl")
+        self.jnl_seq = jseqs[-1] if jseqs else 1
+        for seq in jseqs or [self.jnl_seq]:
+            path = self._jnl_path(seq)
+            if not os.path.exists(path): continue
+            recs, good = read_records(path)
+            for r in recs:
+                if r.get("v", 0) <= self.v: continue
+                self._apply_cells(r.get("c") or [])
+                self.v = r["v"]
+            if seq == self.jnl_seq:
+                self._jnl_f = self._open_tail(path, good)
+        return {"next_id": next_id, "msgs": retained,
+                "lines": ["".join(row) for row in self.canvas], "v": self.v}
+
+    def _retained_count(self) -> int:
+        return sum(len(d) for d in self.msgs.values())
+
+    def _retain(self, msg: Dict[str, Any]):
+        chan = msg.get("chan")
+        d = self.msgs.get(chan)
+        if d is None:
+            d = self.msgs[chan] = deque(maxlen=self.retention(chan))
+        d.append(msg)
+
+    def _apply_cells(self, cells):
+        for x, y, ch in cells:
+            if 0 <= x < self.w and 0 <= y < self.h:
+                self.canvas[y][x] = ch
+
+    # ---- chemin des requêtes (mémoire seulement)
+    def append_msg(self, msg: Dict[str, Any]):
+        self._retain(msg)
+        self.msg_count += 1
+        if self.msg_count > self.msg_limit:
+            # nouveau segment = messages retenus (dont celui-ci), les anciens partiront
+            self.msg_seq += 1
+            base = sorted((m for d in self.msgs.values() for m in d), key=lambda m: m["id"])
+            self._ops.append(("msg_rot", self.msg_seq, base))
+            self.msg_count = len(base)
+            self.msg_limit = len(base) + self.seg_max
+        else:
+            self._ops.append(("msg", msg))
+
+    def append_cells(self, cells: List[List[Any]], v: int):
+        self._apply_cells(cells)
+        self.v = v
+        self._ops.append(("px", {"v": v, "c": cells}))
+
+    def _maybe_snapshot(self):
+        if self.v == self.snap_v: return
+        self.jnl_seq += 1
+        snap = {"v": self.v, "w": self.w, "h": self.h,
+                "lines": ["".join(row) for row in self.canvas]}
+        self._ops.append(("snap", snap, self.jnl_seq))
+        self.snap_v = self.v
+
+    def take(self, snapshot: bool = False) -> List[Tuple]:
+        # lot à écrire (snapshot du canvas en tête de lot si demandé et utile)
+        if snapshot: self._maybe_snapshot()
+        ops, self._ops = self._ops, []
+        return ops
+
+    # ---- écriture (thread)
+    def _write(self, ops: List[Tuple]):
+        if not ops: return
+        self._ensure_files()
+        drop_msgs = drop_jnl = 0
+        for op in ops:
+            kind = op[0]
+            if kind == "msg":
+                self._msg_f.write(_record(op[1]))
+            elif kind == "px":
+                self._jnl_f.write(_record(op[1]))
+            elif kind == "msg_rot":
+                # comme canvas.snap: le nouveau segment n'apparaît que complet et durable,
+                # sinon la reprise (qui lit le dernier segment) repartirait d'un fichier vide
+                self._msg_f.flush(); os.fsync(self._msg_f.fileno()); self._msg_f.close()
+                path = self._msg_path(op[1])
+                with open(path + ".tmp", "wb") as f:
+                    f.write(b"".join(_record(m) for m in op[2]))
+                    f.flush(); os.fsync(f.fileno())
+                os.replace(path + ".tmp", path)
+                self._msg_f = open(path, "ab")
+                drop_msgs = op[1]
+            elif kind == "snap":
+                tmp = self._snap_path() + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(codec.dumps(op[1]))
+                    f.flush(); os.fsync(f.fileno())
+                os.replace(tmp, self._snap_path())
+                self._jnl_f.flush(); os.fsync(self._jnl_f.fileno()); self._jnl_f.close()
+                self._jnl_f = open(self._jnl_path(op[2]), "wb")
+                drop_jnl = op[2]
+        for f in (self._msg_f, self._jnl_f):
+            if f: f.flush(); os.fsync(f.fileno())
+        if drop_msgs or drop_jnl:
+            _fsync_dir(self.path)
+            # les segments remplacés ne servent plus qu'une fois le nouveau durable
+            for seq in self._seqs("msgs", ".log"):
+                if seq < drop_msgs: os.unlink(self._msg_path(seq))
+            for seq in self._seqs("canvas", ".jnl"):
+                if seq < drop_jnl: os.unlink(self._jnl_path(seq))
+
+    def _write_close(self, ops: List[Tuple]):
+        self._write(ops)
+        for f in (self._msg_f, self._jnl_f):
+            if f: f.close()
+        self._msg_f = self._jnl_f = None
+
+class Stores:
+    # Stores des salons résidents. Toutes les écritures passent par un seul verrou
+    # (une écriture en vol à la fois): la fermeture d'un salon évincé est donc sur disque
+    # avant qu'une réouverture ne le relise.
+    def __init__(self, root: str, factory: Callable[[str, str], Store], default_room: str,
+                 fsync_s: float = 0.2, snapshot_s: float = 30.0,
+                 room_ttl_s: float = 0.0, max_room_dirs: int = 0, prune_s: float = 600.0):
+        self.root = root
+        self.factory = factory            # (salon, dossier) -> Store
+        self.default_room = default_room
+        self.fsync_s, self.snapshot_s = fsync_s, snapshot_s
+        self.room_ttl_s, self.max_room_dirs, self.prune_s = room_ttl_s, max_room_dirs, prune_s
+        self._open: Dict[str, Store] = {}
+        # créés par start(), dans la boucle de service (py < 3.10: liés à la boucle courante)
+        self._io: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def path_for(self, room: str) -> str:
+        # le salon par défaut garde la disposition d'origine (DATA_DIR à plat)
+        if room == self.default_room: return self.root
+        return os.path.join(self.root, "rooms", room)
+
+    async def open(self, room: str) -> Tuple[Store, Dict[str, Any]]:
+        async with self._io:
+            st = self.factory(room, self.path_for(room))
+            state = await asyncio.to_thread(st.recover)
+            self._open[room] = st
+            return st, state
+
+    async def close(self, room: str):
+        async with self._io:
+            st = self._open.pop(room, None)
+            if st is not None:
+                await asyncio.to_thread(st._write_close, st.take(snapshot=True))
+
+    async def flush(self, snapshot: bool = False):
+        async with self._io:
+            batch = [(st, st.take(snapshot)) for st in self._open.values()]
+            batch = [(st, ops) for st, ops in batch if ops]
+            if batch:
+                await asyncio.to_thread(lambda: [st._write(ops) for st, ops in batch])
+
+    def _prune(self, keep) -> int:
+        # dossiers des salons fermés: âge = dernière écriture d'un de leurs fichiers
+        base = os.path.join(self.root, "rooms")
+        try:
+            names = os.listdir(base)
+        except FileNotFoundError:
+            return 0
+        now, dirs = time.time(), []
+        for name in names:
+            if name in keep: continue
+            path = os.path.join(base, name)
+            try:
+                with os.scandir(path) as it:
+                    last = max((e.stat().st_mtime for e in it), default=os.stat(path).st_mtime)
+            except OSError:
+                continue
+            dirs.append((last, path))
+        dirs.sort()
+        over = len(dirs) - self.max_room_dirs if self.max_room_dirs > 0 else 0
+        drop = [p for i, (last, p) in enumerate(dirs)
+                if i < over or (self.room_ttl_s > 0 and now - last > self.room_ttl_s)]
+        for path in drop:
+            shutil.rmtree(path, ignore_errors=True)
+        return len(drop)
+
+    async def prune(self) -> int:
+        # sous le verrou d'écriture: un salon ne peut pas être rouvert pendant sa suppression
+        if self.room_ttl_s <= 0 and self.max_room_dirs <= 0: return 0
+        async with self._io:
+            return await asyncio.to_thread(self._prune, set(self._open))
+
+    async def _run(self):
+        # à l'arrêt: snapshot + dernier lot de chaque salon
+        last_snap = last_prune = time.monotonic()
+        await self.prune()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.fsync_s)
+            except asyncio.TimeoutError:
+                pass
+            snap = self._stopping.is_set() or time.monotonic() - last_snap >= self.snapshot_s
+            if snap: last_snap = time.monotonic()
+            await self.flush(snap)
+            if time.monotonic() - last_prune >= self.prune_s:
+                last_prune = time.monotonic()
+                await self.prune()
+        for room in list(self._open):
+            await self.close(room)
+
+    async def start(self):
+        self._io, self._stopping = asyncio.Lock(), asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+def open_stores(factory: Callable[[str, str], Store], default_room: str,
+                room_ttl_s: float = 0.0, max_room_dirs: int = 0) -> Optional[Stores]:
+    path = os.getenv("PICOCHAN_DATA_DIR")
+    if not path: return None
+    return Stores(path, factory, default_room,
+                  fsync_s=float(os.getenv("PICOCHAN_FSYNC_MS", "200")) / 1000.0,
+                  snapshot_s=float(os.getenv("PICOCHAN_SNAPSHOT_S", "30")),
+                  room_ttl_s=room_ttl_s, max_room_dirs=max_room_dirs)